@@ -15,12 +15,58 @@
 
 #RBTODO make all get/put Index based on timerange
 
+import struct
 import numpy as np
 import cStringIO
 import blosc
+from mortonbitmap import MortonBitmap
 import logging
 logger=logging.getLogger("neurodata")
 
+# prefix of an index record that carries a bounding box ahead of the bitmap
+BBOX_MAGIC = 'NDBB\x01'
+BBOX_FORMAT = '<6q'
+
+
+def labelBoxes ( labels, lows, highs ):
+  """Combine boxes that share a label. lows and highs are (N,3) arrays of x,y,z corners, highs exclusive.
+     Returns the sorted unique labels and the combined low and high corner of each."""
+
+  labels = np.asarray ( labels )
+  order = np.argsort ( labels, kind='mergesort' )
+  labels = labels[order]
+  starts = np.r_[ 0, np.nonzero(np.diff(labels))[0] + 1 ].astype(np.intp)
+  if len(labels) == 0:
+    return labels, np.empty((0,3), dtype=np.int64), np.empty((0,3), dtype=np.int64)
+  return labels[starts], np.minimum.reduceat ( np.asarray(lows)[order], starts ), np.maximum.reduceat ( np.asarray(highs)[order], starts )
+
+
+def denseLabels ( data, keys ):
+  """Unique (label, zindex) pairs in a cube aligned z,y,x buffer. keys is the z,y,x array of cube keys.
+     Returns label and zindex arrays sorted by label then zindex. Label 0 is skipped."""
+
+  [znumcubes, ynumcubes, xnumcubes] = keys.shape
+  [zcubedim, ycubedim, xcubedim] = [ data.shape[0]/znumcubes, data.shape[1]/ynumcubes, data.shape[2]/xnumcubes ]
+
+  # position of each cube within a slab of cubes
+  cubepos = np.arange ( ynumcubes*xnumcubes, dtype=np.uint64 ).reshape ( 1, ynumcubes, 1, xnumcubes, 1 )
+
+  labels = []
+  listofidxs = []
+  # one slab of cubes at a time to bound memory
+  for z in range(znumcubes):
+    slab = data [ z*zcubedim:(z+1)*zcubedim ].reshape ( zcubedim, ynumcubes, ycubedim, xnumcubes, xcubedim )
+    # pack the label and cube position into one word so that one unique finds every pair
+    packed = ( slab.astype(np.uint64) << np.uint64(32) ) | cubepos
+    packed = np.unique ( packed [ slab != 0 ] )
+    labels.append ( packed >> np.uint64(32) )
+    listofidxs.append ( keys[z].ravel()[ ( packed & np.uint64(0xffffffff) ).astype(np.intp) ] )
+
+  labels = np.concatenate ( labels )
+  listofidxs = np.concatenate ( listofidxs )
+  order = np.lexsort ( (listofidxs, labels) )
+  return labels[order], listofidxs[order]
+
 
 class AnnotateIndex:
 
@@ -37,47 +83,153 @@ class AnnotateIndex:
       self.NPZ = False
    
 
-  def getIndex ( self, ch, entityid, timestamp, resolution, update=False):
-    """Retrieve the index for the annotation with id"""  
+  def _decode ( self, idxstr ):
+    """Bitmap and bounding box of a stored index. The box is None if it is not known.
+       Reads bitmaps and legacy blosc or npz arrays."""
+
+    bbox = None
+    if self.NPZ:
+      return MortonBitmap.fromKeys ( np.load ( cStringIO.StringIO ( idxstr ) ) ), bbox
+
+    if idxstr[:len(BBOX_MAGIC)] == BBOX_MAGIC:
+      values = struct.unpack_from ( BBOX_FORMAT, idxstr, len(BBOX_MAGIC) )
+      bbox = ( list(values[:3]), list(values[3:]) )
+      idxstr = idxstr [ len(BBOX_MAGIC)+struct.calcsize(BBOX_FORMAT): ]
+
+    if MortonBitmap.isBitmap ( idxstr ):
+      return MortonBitmap.deserialize ( idxstr ), bbox
+    else:
+      return MortonBitmap.fromKeys ( blosc.unpack_array(idxstr) ), bbox
+
+
+  def _encode ( self, index, bbox=None ):
+    """Stored form of an index given as a bitmap or an array of zindexes. bbox is an optional voxel
+       bounding box ([xmin,ymin,zmin], [xmax,ymax,zmax]) with the upper corner exclusive."""
+
+    if not isinstance ( index, MortonBitmap ):
+      index = MortonBitmap.fromKeys ( index )
+
+    if self.NPZ:
+      fileobj = cStringIO.StringIO ()
+      np.save ( fileobj, index.toKeys() )
+      return fileobj.getvalue()
+    elif bbox is not None:
+      return BBOX_MAGIC + struct.pack ( BBOX_FORMAT, *(list(bbox[0])+list(bbox[1])) ) + index.serialize()
+    else:
+      return index.serialize()
+
+
+  def getBitmap ( self, ch, entityid, timestamp, resolution, update=False):
+    """Retrieve the index for the annotation with id as a bitmap. None if there is no index."""  
     
     idxstr = self.kvio.getIndex(ch, entityid, timestamp, resolution, update)
     if idxstr:
-      if self.NPZ:
-        fobj = cStringIO.StringIO ( idxstr )
-        return np.load ( fobj )
-      else:
-        return blosc.unpack_array(idxstr)
+      return self._decode ( idxstr )[0]
+    else:
+      return None
+
+
+  def getIndex ( self, ch, entityid, timestamp, resolution, update=False):
+    """Retrieve the index for the annotation with id"""  
+    
+    index = self.getBitmap(ch, entityid, timestamp, resolution, update)
+    if index is not None:
+      return index.toKeys()
     else:
       return []
        
   
-  def putIndex ( self, ch, entityid, timestamp, resolution, index, update=False ):
-    """Write the index for the annotation with id"""
+  def putIndex ( self, ch, entityid, timestamp, resolution, index, update=False, bbox=None ):
+    """Write the index for the annotation with id. The index is a bitmap or an array of zindexes.
+       Writing without a bounding box clears any stored box."""
 
-    if self.NPZ:
-      fileobj = cStringIO.StringIO ()
-      np.save ( fileobj, index )
-      self.kvio.putIndex(ch, entityid, timestamp, resolution, fileobj.getvalue(), update )
-    else:
-      self.kvio.putIndex(ch, entityid, timestamp, resolution, blosc.pack_array(index), update)
+    self.kvio.putIndex(ch, entityid, timestamp, resolution, self._encode(index, bbox), update)
 
 
-  def updateIndexDense(self, ch, index, timestamp, resolution ):
-    """Updated the database index table with the input index hash table"""
+  def getIndexes ( self, ch, listofids, timestamp, resolution, update=False ):
+    """Retrieve the indexes for many annotations. Returns {annid: bitmap} for the ids that have an index."""
+
+    return dict ( [ (annid, index) for annid, (index, bbox) in self._getRecords(ch, listofids, timestamp, resolution, update).iteritems() ] )
+
+
+  def _getRecords ( self, ch, listofids, timestamp, resolution, update=False ):
+    """Returns {annid: (bitmap, bbox)} for the ids that have an index"""
+
+    records = {}
+    for annid, idxstr in self.kvio.getIndexes(ch, listofids, timestamp, resolution, update).iteritems():
+      records[annid] = self._decode ( idxstr )
+    return records
+
+
+  def putIndexes ( self, ch, timestamp, resolution, listofindexes ):
+    """Write the indexes for many annotations. listofindexes holds (annid, index, update) or (annid, index, update, bbox)."""
+
+    listofstrs = []
+    for record in listofindexes:
+      bbox = record[3] if len(record) > 3 else None
+      listofstrs.append ( (record[0], self._encode(record[1], bbox), record[2]) )
+    self.kvio.putIndexes(ch, timestamp, resolution, listofstrs)
+
 
-    for key, value in index.iteritems():
-      cubelist = list(value)
-      cubeindex = np.array(cubelist, dtype=np.uint64)
+  def getBoundingBoxes ( self, ch, listofids, timestamp, resolution ):
+    """Returns {annid: ([xmin,ymin,zmin], [xmax,ymax,zmax])} for the ids with a known bounding box"""
+
+    boxes = {}
+    for annid, (index, bbox) in self._getRecords(ch, listofids, timestamp, resolution).iteritems():
+      if bbox is not None:
+        boxes[annid] = bbox
+    return boxes
+
+
+  def invalidateBoundingBoxes ( self, ch, listofids, timestamp, resolution ):
+    """Forget the bounding boxes of annotations that have lost voxels"""
+
+    listofindexes = []
+    for annid, (index, bbox) in self._getRecords(ch, listofids, timestamp, resolution, True).iteritems():
+      if bbox is not None:
+        listofindexes.append ( (annid, index, True) )
+    self.putIndexes(ch, timestamp, resolution, listofindexes)
+
+
+  def updateIndexDense(self, ch, labels, listofidxs, timestamp, resolution, boxes=None ):
+    """Update the database index table with arrays of (label, zindex) pairs sorted by label.
+       boxes maps labels to the bounding box of the voxels written. Without one the stored box is cleared."""
+
+    if boxes is None:
+      boxes = {}
+
+    labels = np.asarray ( labels, dtype=np.uint64 )
+    listofidxs = np.asarray ( listofidxs, dtype=np.uint64 )
+    if len(labels) == 0:
+      return
+
+    # split the pairs into runs of the same label
+    breaks = np.nonzero ( np.diff(labels) )[0] + 1
+    listofids = labels[np.r_[0, breaks]].tolist()
+
+    # read and lock all the current indexes at once
+    currecords = self._getRecords(ch, listofids, timestamp, resolution, True)
+
+    listofindexes = []
+    for key, cubeindex in zip ( listofids, np.split(listofidxs, breaks) ):
       
-      curindex = self.getIndex(ch, key, timestamp, resolution, True)
+      bbox = boxes.get(key)
          
-      if curindex == []:
-        self.putIndex(ch, key, timestamp, resolution, cubeindex, False )
+      if key not in currecords:
+        listofindexes.append ( (key, MortonBitmap.fromKeys(cubeindex), False, bbox) )
             
       else:
         # Update index to the union of the currentIndex and the updated index
-        newIndex = np.union1d(curindex, cubeindex)
-        self.putIndex(ch, key, timestamp, resolution, newIndex, True)
+        curindex, curbbox = currecords[key]
+        # grow the box. an unknown box stays unknown until it is rebuilt.
+        if bbox is not None and curbbox is not None:
+          bbox = ( np.minimum(curbbox[0], bbox[0]).tolist(), np.maximum(curbbox[1], bbox[1]).tolist() )
+        else:
+          bbox = None
+        listofindexes.append ( (key, curindex.unionUpdate(MortonBitmap.fromKeys(cubeindex)), True, bbox) )
+
+    # write them back in one batch
+    self.putIndexes(ch, timestamp, resolution, listofindexes)
 
   
   def deleteIndexResolution ( self, ch, annid, res ):
@@ -98,26 +250,12 @@ class AnnotateIndex:
   def updateIndex ( self, ch, entityid, index, timestamp, resolution ):
     """Updated the database index table with the input index hash table"""
 
-    curindex = self.getIndex(ch, entityid, resolution, True)
+    curindex = self.getBitmap(ch, entityid, timestamp, resolution, True)
 
-    if curindex == []:
-        
-      if self.NPZ:
-        fileobj = cStringIO.StringIO ()
-        np.save ( fileobj, index )
-        self.kvio.putIndex(ch, entityid, timestamp, resolution, fileobj.getvalue())
-      else:
-        self.kvio.putIndex(ch, entityid, timestamp, resolution, blosc.pack_array(index))
+    if curindex is None:
+      self.putIndex(ch, entityid, timestamp, resolution, index)
 
     else:
-        
       # Update Index to the union of the currentIndex and the updated index
-      newIndex = np.union1d(curindex, index)
-
-      # Update the index in the database
-      if self.NPZ:
-        fileobj = cStringIO.StringIO ()
-        np.save ( fileobj, newIndex )
-        self.kvio.putIndex(ch, entityid, timestamp, resolution, fileobj.getvalue(), True )
-      else:
-        self.kvio.putIndex(ch, entityid, timestamp, resolution, blosc.pack_array(newIndex), True )
+      curindex.unionUpdate ( MortonBitmap.fromKeys(index) )
+      self.putIndex(ch, entityid, timestamp, resolution, curindex, True )
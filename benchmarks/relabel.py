@@ -0,0 +1,90 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time the np.vectorize relabeling that annoCutout, annoCubeOffsets, deleteAnnoData and shaveEntityDense
+   used against the numpy masks that replaced it. The volume is walked one cube at a time, as those paths do,
+   so only one cube is held in memory.
+
+   python benchmarks/relabel.py [--size 1024] [--cubedim 128 128 16]
+"""
+
+import time
+import argparse
+import numpy as np
+
+
+def remapOld ( data, remapid ):
+  vec_func = np.vectorize ( lambda x: np.uint32(remapid) if x != 0 else np.uint32(0) )
+  return vec_func ( data )
+
+def remapNew ( data, remapid ):
+  data[data != 0] = remapid
+  return data
+
+def deleteOld ( data, annoid ):
+  vec_func = np.vectorize ( lambda x: np.uint32(0) if x == annoid else x )
+  return vec_func ( data )
+
+def deleteNew ( data, annoid ):
+  data[data == annoid] = 0
+  return data
+
+def shaveOld ( data, entityid ):
+  vec_func = np.vectorize ( lambda x: 0 if x == 0 else entityid )
+  return vec_func ( data )
+
+def shaveNew ( data, entityid ):
+  return np.where ( data != 0, np.uint32(entityid), np.uint32(0) )
+
+
+BENCHMARKS = [ ( 'remap (annoCutout, annoCubeOffsets)', remapOld, remapNew ),
+               ( 'delete (deleteAnnoData)', deleteOld, deleteNew ),
+               ( 'shave mask (shaveEntityDense)', shaveOld, shaveNew ) ]
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description='Time vectorized against masked relabeling over a volume.')
+  parser.add_argument('--size', type=int, default=1024, help='edge of the cubic volume in voxels')
+  parser.add_argument('--cubedim', type=int, nargs=3, default=[128,128,16], help='x y z size of a cube')
+  result = parser.parse_args()
+
+  [xcubedim, ycubedim, zcubedim] = result.cubedim
+  numcubes = (result.size/xcubedim) * (result.size/ycubedim) * (result.size/zcubedim)
+  print "{}^3 voxels in {} cubes of {}x{}x{}".format(result.size, numcubes, xcubedim, ycubedim, zcubedim)
+
+  rng = np.random.RandomState(0)
+  for name, old, new in BENCHMARKS:
+
+    oldtime = 0.0
+    newtime = 0.0
+    for i in range(numcubes):
+      # a few labels and background
+      data = rng.randint ( 0, 8, size=(zcubedim, ycubedim, xcubedim) ).astype(np.uint32)
+
+      start = time.time()
+      expected = old ( data.copy(), 3 )
+      oldtime += time.time() - start
+
+      start = time.time()
+      actual = new ( data, 3 )
+      newtime += time.time() - start
+
+      assert np.array_equal ( expected, actual )
+
+    print "{:40} np.vectorize {:9.2f}s  numpy {:7.2f}s  {:7.0f}x".format(name, oldtime, newtime, oldtime/newtime)
+
+
+if __name__ == '__main__':
+  main()
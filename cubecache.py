@@ -0,0 +1,116 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from singletontype import SingletonType
+import logging
+logger = logging.getLogger("neurodata")
+
+"""
+.. module:: cubecache
+    :synopsis: Process wide LRU cache of decompressed cubes.
+    Entries are keyed by (project, channel, resolution, zidx, timestamp, neariso) and carry the
+    version of the blob they were decoded from. An entry is only served if the store still holds that version.
+"""
+
+
+def version ( cubestr ):
+  """Version of a serialized cube. Matches CRC32(cube), LENGTH(cube) computed by the database.
+     This is a checksum, not a revision counter. A rewrite to a different blob with the same CRC32 and length,
+     about 1 in 2**32, would serve the stale array until the entry is evicted or invalidated by a local write."""
+  return ( zlib.crc32(cubestr) & 0xffffffff, len(cubestr) )
+
+
+class CubeCache(object):
+  """LRU cache of decoded cube arrays bounded by a memory budget. Disabled when the budget is 0."""
+  __metaclass__ = SingletonType
+
+  def __init__(self):
+
+    self.lock = threading.Lock()
+    # key -> (version, array) from least to most recently used
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.maxbytes = getattr(settings, 'SPDB_CUBE_CACHE_BYTES', 0)
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def enabled(self):
+    return self.maxbytes > 0
+
+  def get(self, key, version):
+    """The cached array for key if it was decoded from version. Callers must not modify it."""
+
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or entry[0] != version:
+        self.misses += 1
+        return None
+      # most recently used goes to the end
+      del self.entries[key]
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def cached(self, keys):
+    """The keys that have an entry of any version"""
+
+    with self.lock:
+      return [ key for key in keys if key in self.entries ]
+
+  def put(self, key, data, version):
+    """Cache an array decoded from a blob of the given version. The array is made read only."""
+
+    if not self.enabled() or data.nbytes > self.maxbytes:
+      return
+
+    data.flags.writeable = False
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.nbytes -= old[1].nbytes
+      self.entries[key] = (version, data)
+      self.nbytes += data.nbytes
+
+      # evict least recently used entries until we are within budget
+      while self.nbytes > self.maxbytes:
+        oldkey, (oldversion, olddata) = self.entries.popitem(last=False)
+        self.nbytes -= olddata.nbytes
+        self.evictions += 1
+
+  def invalidate(self, keys):
+    """Drop the entries for keys that were written"""
+
+    with self.lock:
+      for key in keys:
+        old = self.entries.pop(key, None)
+        if old is not None:
+          self.nbytes -= old[1].nbytes
+
+  def clear(self):
+
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    """Counters and usage as a dict"""
+
+    with self.lock:
+      return { 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions, 'entries' : len(self.entries), 'bytes' : self.nbytes, 'maxbytes' : self.maxbytes }
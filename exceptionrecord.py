@@ -0,0 +1,98 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import numpy as np
+import blosc
+from spdb import zindex
+from spdb.spatialdberror import SpatialDBError
+import logging
+logger=logging.getLogger("neurodata")
+
+"""
+.. module:: exceptionrecord
+    :synopsis: All the exceptions of one cube in one record.
+    The record is CSR style: sorted ids, offsets into the voxel list and the Morton
+    code of each voxel within the cube. In memory an exception is one uint64 key,
+    the id in the upper 32 bits and the voxel Morton code in the lower 32 bits,
+    so merges are numpy set operations on sorted key arrays.
+"""
+
+# prefix that tells a consolidated record from a legacy blosc array of voxels
+MAGIC = 'NDEX\x01'
+
+# exceptions table id of the consolidated record. 0 is never an annotation.
+RECORD_ID = 0
+
+LOWBITS = np.uint64(0xffffffff)
+
+
+def toKeys ( annid, voxels ):
+  """Keys for an id and an (N,3) array of x,y,z voxel offsets within a cube"""
+
+  voxels = np.asarray ( voxels, dtype=np.uint64 ).reshape(-1,3)
+  return np.unique ( ( np.uint64(annid) << np.uint64(32) ) | zindex.XYZMorton(voxels) )
+
+
+def fromKeys ( keys ):
+  """List of (id, voxels) with an (N,3) uint32 array of x,y,z for each id in the keys"""
+
+  keys = np.asarray ( keys, dtype=np.uint64 )
+  annids = keys >> np.uint64(32)
+  breaks = np.nonzero ( np.diff(annids) )[0] + 1
+  if len(keys) == 0:
+    return []
+  voxels = zindex.MortonXYZ ( keys & LOWBITS ).astype(np.uint32)
+  return zip ( annids[np.r_[0, breaks]].tolist(), np.split(voxels, breaks) )
+
+
+def selectIds ( keys, annids ):
+  """The keys that belong to any of annids"""
+
+  keys = np.asarray ( keys, dtype=np.uint64 )
+  return keys [ np.in1d ( keys >> np.uint64(32), np.asarray(annids, dtype=np.uint64) ) ]
+
+
+def pack ( keys ):
+  """Record string for sorted unique keys"""
+
+  keys = np.asarray ( keys, dtype=np.uint64 )
+  annids, starts = np.unique ( keys >> np.uint64(32), return_index=True )
+  offsets = np.r_[ starts, len(keys) ].astype('<u4')
+  voxels = ( keys & LOWBITS ).astype('<u4')
+  body = struct.pack ( '<I', len(annids) ) + annids.astype('<u4').tostring() + offsets.tostring() + voxels.tostring()
+  return MAGIC + blosc.compress ( body, typesize=4 )
+
+
+def isRecord ( data ):
+  """True if the string was written by pack"""
+  return data[:len(MAGIC)] == MAGIC
+
+
+def unpack ( data ):
+  """Sorted keys of a record string"""
+
+  try:
+    body = blosc.decompress ( data[len(MAGIC):] )
+    (count,) = struct.unpack_from ( '<I', body, 0 )
+    annids = np.frombuffer ( body, dtype='<u4', count=count, offset=4 )
+    offsets = np.frombuffer ( body, dtype='<u4', count=count+1, offset=4+4*count )
+    voxels = np.frombuffer ( body, dtype='<u4', offset=4+4*count+4*(count+1) )
+  except Exception, e:
+    logger.error("Failed to decode the exception record. {}".format(e))
+    raise SpatialDBError("Failed to decode the exception record. {}".format(e))
+
+  # expand the ids over their voxels
+  annids = np.repeat ( annids.astype(np.uint64), np.diff(offsets.astype(np.int64)) )
+  return ( annids << np.uint64(32) ) | voxels.astype(np.uint64)
@@ -0,0 +1,244 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import numpy as np
+import blosc
+from spdb.spatialdberror import SpatialDBError
+import logging
+logger=logging.getLogger("neurodata")
+
+"""
+.. module:: mortonbitmap
+    :synopsis: Compressed bitmap of Morton keys in the style of roaring bitmaps.
+    Keys are split on their upper 48 bits into containers that hold the lower 16 bits.
+    Sparse containers are sorted uint16 arrays and dense containers are 65536 bit bitmaps.
+"""
+
+# prefix that tells a serialized bitmap from a legacy blosc packed array
+MAGIC = 'NDRB\x01'
+
+# containers with more keys than this are stored as bitmaps
+ARRAY_MAX = 4096
+# bytes in a bitmap container
+BITMAP_BYTES = 8192
+
+# set bits in every byte value
+POPCOUNT = np.array ( [ bin(i).count('1') for i in range(256) ], dtype=np.uint32 )
+
+
+def _isBitmap ( container ):
+  return container.dtype == np.uint8
+
+def _toBits ( container ):
+  """Bitmap form of a container"""
+
+  if _isBitmap(container):
+    return container
+  bits = np.zeros ( 65536, dtype=np.bool_ )
+  bits[container] = True
+  return np.packbits ( bits )
+
+def _fromBits ( bits ):
+  """Smallest form of a bitmap container. None if it is empty."""
+
+  card = POPCOUNT[bits].sum()
+  if card == 0:
+    return None
+  elif card <= ARRAY_MAX:
+    return np.flatnonzero ( np.unpackbits(bits) ).astype(np.uint16)
+  else:
+    return bits
+
+def _cardinality ( container ):
+  return int(POPCOUNT[container].sum()) if _isBitmap(container) else len(container)
+
+def _contains ( bits, lows ):
+  """Mask of the lows that are set in a bitmap container"""
+  return np.unpackbits(bits)[lows].astype(np.bool_)
+
+
+def _union ( a, b ):
+
+  if not _isBitmap(a) and not _isBitmap(b):
+    lows = np.union1d ( a, b ).astype(np.uint16)
+    return lows if len(lows) <= ARRAY_MAX else _toBits(lows)
+  return _toBits(a) | _toBits(b)
+
+def _intersection ( a, b ):
+
+  if _isBitmap(a) and _isBitmap(b):
+    return _fromBits ( a & b )
+  elif _isBitmap(a):
+    lows = b [ _contains(a, b) ]
+  elif _isBitmap(b):
+    lows = a [ _contains(b, a) ]
+  else:
+    lows = np.intersect1d ( a, b, assume_unique=True ).astype(np.uint16)
+  return lows if len(lows) else None
+
+def _difference ( a, b ):
+
+  if _isBitmap(a):
+    return _fromBits ( a & ~_toBits(b) )
+  elif _isBitmap(b):
+    lows = a [ ~_contains(b, a) ]
+  else:
+    lows = np.setdiff1d ( a, b, assume_unique=True ).astype(np.uint16)
+  return lows if len(lows) else None
+
+
+class MortonBitmap:
+  """Set of Morton keys stored as compressed containers keyed by the upper 48 bits"""
+
+  def __init__ ( self, containers=None ):
+    """Create an empty bitmap"""
+    # upper bits -> container of lower 16 bits
+    self.containers = containers if containers is not None else {}
+
+  @staticmethod
+  def fromKeys ( keys ):
+    """Bitmap of an array of Morton keys"""
+
+    keys = np.unique ( np.asarray ( keys, dtype=np.uint64 ) )
+    highs = keys >> np.uint64(16)
+    lows = ( keys & np.uint64(0xffff) ).astype(np.uint16)
+
+    # split into runs of the same upper bits
+    breaks = np.nonzero ( np.diff(highs) )[0] + 1
+    containers = {}
+    if len(keys):
+      for high, container in zip ( highs[np.r_[0, breaks]].tolist(), np.split(lows, breaks) ):
+        containers[high] = container if len(container) <= ARRAY_MAX else _toBits(container)
+    return MortonBitmap ( containers )
+
+  def toKeys ( self ):
+    """Sorted uint64 array of the Morton keys"""
+
+    keys = [ np.empty ( 0, dtype=np.uint64 ) ]
+    for high in sorted ( self.containers ):
+      container = self.containers[high]
+      lows = np.flatnonzero ( np.unpackbits(container) ) if _isBitmap(container) else container
+      keys.append ( lows.astype(np.uint64) | ( np.uint64(high) << np.uint64(16) ) )
+    return np.concatenate ( keys )
+
+  def __len__ ( self ):
+    return sum ( [ _cardinality(container) for container in self.containers.itervalues() ] )
+
+  def __iter__ ( self ):
+    return iter ( self.toKeys() )
+
+  def __contains__ ( self, key ):
+    container = self.containers.get ( int(key) >> 16 )
+    if container is None:
+      return False
+    low = int(key) & 0xffff
+    if _isBitmap(container):
+      return bool ( container[low >> 3] & ( 0x80 >> (low & 7) ) )
+    i = np.searchsorted ( container, low )
+    return i < len(container) and container[i] == low
+
+  def copy ( self ):
+    return MortonBitmap ( dict ( [ (high, container.copy()) for high, container in self.containers.iteritems() ] ) )
+
+  def unionUpdate ( self, other ):
+    """Add the keys of other in place"""
+
+    for high, container in other.containers.iteritems():
+      mine = self.containers.get(high)
+      self.containers[high] = container.copy() if mine is None else _union ( mine, container )
+    return self
+
+  def intersectionUpdate ( self, other ):
+    """Keep only the keys that are also in other"""
+
+    for high in self.containers.keys():
+      theirs = other.containers.get(high)
+      container = None if theirs is None else _intersection ( self.containers[high], theirs )
+      if container is None:
+        del self.containers[high]
+      else:
+        self.containers[high] = container
+    return self
+
+  def differenceUpdate ( self, other ):
+    """Remove the keys of other in place"""
+
+    for high, theirs in other.containers.iteritems():
+      mine = self.containers.get(high)
+      if mine is None:
+        continue
+      container = _difference ( mine, theirs )
+      if container is None:
+        del self.containers[high]
+      else:
+        self.containers[high] = container
+    return self
+
+  def union ( self, other ):
+    return self.copy().unionUpdate ( other )
+
+  def intersection ( self, other ):
+    return self.copy().intersectionUpdate ( other )
+
+  def difference ( self, other ):
+    return self.copy().differenceUpdate ( other )
+
+  __or__ = union
+  __and__ = intersection
+  __sub__ = difference
+  __ior__ = unionUpdate
+  __iand__ = intersectionUpdate
+  __isub__ = differenceUpdate
+
+  def serialize ( self ):
+    """Compressed byte string. Header of upper bits and cardinalities followed by the containers in order."""
+
+    highs = sorted ( self.containers )
+    cards = [ _cardinality(self.containers[high]) for high in highs ]
+    body = [ struct.pack ( '<I', len(highs) ), np.array(highs, dtype='<u8').tostring(), np.array(cards, dtype='<u4').tostring() ]
+    body.extend ( [ self.containers[high].astype(self.containers[high].dtype.newbyteorder('<')).tostring() for high in highs ] )
+    return MAGIC + blosc.compress ( ''.join(body), typesize=1 )
+
+  @staticmethod
+  def isBitmap ( data ):
+    """True if the string was written by serialize"""
+    return data[:len(MAGIC)] == MAGIC
+
+  @staticmethod
+  def deserialize ( data ):
+    """Bitmap from a string written by serialize"""
+
+    try:
+      body = blosc.decompress ( data[len(MAGIC):] )
+      (count,) = struct.unpack_from ( '<I', body, 0 )
+      offset = 4
+      highs = np.frombuffer ( body, dtype='<u8', count=count, offset=offset ).tolist()
+      offset += 8*count
+      cards = np.frombuffer ( body, dtype='<u4', count=count, offset=offset ).tolist()
+      offset += 4*count
+
+      containers = {}
+      for high, card in zip ( highs, cards ):
+        if card > ARRAY_MAX:
+          containers[high] = np.frombuffer ( body, dtype=np.uint8, count=BITMAP_BYTES, offset=offset ).copy()
+          offset += BITMAP_BYTES
+        else:
+          containers[high] = np.frombuffer ( body, dtype='<u2', count=card, offset=offset ).astype(np.uint16)
+          offset += 2*card
+    except Exception, e:
+      logger.error("Failed to decode the bitmap index. {}".format(e))
+      raise SpatialDBError("Failed to decode the bitmap index. {}".format(e))
+
+    return MortonBitmap ( containers )
@@ -0,0 +1,119 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import threading
+from collections import defaultdict
+import MySQLdb
+from django.conf import settings
+from singletontype import SingletonType
+import logging
+logger = logging.getLogger("neurodata")
+
+
+class MySQLPool(object):
+  """Process wide pool of idle MySQL connections keyed by host, db and user"""
+  __metaclass__ = SingletonType
+
+  def __init__(self):
+
+    self.lock = threading.Lock()
+    self.pid = os.getpid()
+    # (host, db, user) -> list of (connection, time returned)
+    self.idle = defaultdict(list)
+    # id of every connection handed out -> pid of the process that opened it
+    self.owners = {}
+    # connections inherited across a fork. never closed here, that would close the parent's socket.
+    self.orphans = []
+
+    self.max_idle = getattr(settings, 'MYSQL_POOL_MAX_IDLE', 8)
+    self.idle_timeout = getattr(settings, 'MYSQL_POOL_IDLE_TIMEOUT', 300)
+
+  def _checkFork(self):
+    """Drop all pooled connections if we are in a forked child"""
+
+    if self.pid != os.getpid():
+      for connections in self.idle.itervalues():
+        self.orphans.extend ( [ conn for (conn, returned) in connections ] )
+      self.idle.clear()
+      self.owners.clear()
+      self.pid = os.getpid()
+
+  def _discard(self, conn):
+    """Close a connection that is no longer wanted"""
+
+    self.owners.pop(id(conn), None)
+    try:
+      conn.close()
+    except MySQLdb.Error:
+      pass
+
+  def _evictIdle(self):
+    """Close connections that have been idle for too long"""
+
+    now = time.time()
+    for key, connections in self.idle.items():
+      for (conn, returned) in connections:
+        if now - returned > self.idle_timeout:
+          self._discard(conn)
+      self.idle[key] = [ (conn, returned) for (conn, returned) in connections if now - returned <= self.idle_timeout ]
+
+  def getConnection(self, host, user, passwd, db):
+    """Borrow a live connection. Opens a new one if none are idle."""
+
+    key = (host, db, user)
+    with self.lock:
+      self._checkFork()
+      self._evictIdle()
+      while self.idle[key]:
+        conn, returned = self.idle[key].pop()
+        # health check before handing it out
+        try:
+          conn.ping()
+          return conn
+        except MySQLdb.Error, e:
+          logger.warning("Discarding dead pooled connection to {}, {}. {}".format(host, db, e))
+          self._discard(conn)
+
+    conn = MySQLdb.connect (host = host, user = user, passwd = passwd, db = db)
+    with self.lock:
+      self.owners[id(conn)] = os.getpid()
+    return conn
+
+  def putConnection(self, conn, host, user, db):
+    """Return a borrowed connection to the pool"""
+
+    key = (host, db, user)
+    with self.lock:
+      self._checkFork()
+
+      # a connection opened before a fork stays with the parent
+      if self.owners.get(id(conn)) != self.pid:
+        self.orphans.append(conn)
+        return
+
+    # release anything the borrower left open
+    try:
+      conn.rollback()
+    except MySQLdb.Error:
+      with self.lock:
+        self._discard(conn)
+      return
+
+    with self.lock:
+      if len(self.idle[key]) < self.max_idle:
+        self.idle[key].append ( (conn, time.time()) )
+      else:
+        self._discard(conn)
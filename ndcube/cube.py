@@ -91,6 +91,19 @@ class Cube(object):
     """Serialize the cube data"""
     return self.toBlosc()
 
+  @staticmethod
+  def unpack ( compressed_data ):
+    """Decompress serialized cube data into an array without building a cube"""
+
+    try:
+      return blosc.unpack_array(compressed_data[:])
+    except Exception as e:
+      try:
+        return np.load ( cStringIO.StringIO ( zlib.decompress ( compressed_data[:] ) ) )
+      except:
+        logger.error("Failed to decompress database cube. Data integrity concern.")
+        raise SpatialDBError("Failed to decompress database cube. Data integrity concern.")
+
   def fromNPZ ( self, compressed_data ):
     """Load the cube from a pickled and zipped blob"""
 
@@ -40,6 +40,20 @@ class TimeCube(Cube):
        
     self.data [ time-self.time_range[0], zoffset:zoffset+other.zdim, yoffset:yoffset+other.ydim, xoffset:xoffset+other.xdim] = other.data [:,:,:]
   
+  def addArray(self, data, time, corner):
+    """Add the array of a smaller cube at a voxel corner of a larger cube. Only the overlap is copied."""
+
+    zdim, ydim, xdim = data.shape[-3:]
+    zsize, ysize, xsize = self.data.shape[-3:]
+
+    # intersect the smaller cube with the larger cube
+    xlow, ylow, zlow = max(corner[0], 0), max(corner[1], 0), max(corner[2], 0)
+    xhigh, yhigh, zhigh = min(corner[0]+xdim, xsize), min(corner[1]+ydim, ysize), min(corner[2]+zdim, zsize)
+    if xlow >= xhigh or ylow >= yhigh or zlow >= zhigh:
+      return
+
+    self.data [ time-self.time_range[0], zlow:zhigh, ylow:yhigh, xlow:xhigh ] = data [ ..., zlow-corner[2]:zhigh-corner[2], ylow-corner[1]:yhigh-corner[1], xlow-corner[0]:xhigh-corner[0] ]
+  
   # @override(Cube)
   def trim(self, xoffset, xsize, yoffset, ysize, zoffset, zsize):
     """Trim off the excess data"""
@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 from abc import ABCMeta, abstractmethod
 from ndlib.ndtype import *
+from spatialdberror import SpatialDBError
 
 class KVIO(object):
   # __metaclass__ = ABCMeta
@@ -41,6 +43,10 @@ class KVIO(object):
   def rollback ( self ):
     """Rollback the transaction. To be called on exceptions."""
     pass
+
+  def flushCubes ( self ):
+    """Write the cubes buffered by the transaction without ending it"""
+    pass
   
   @abstractmethod
   def getCube(self, ch, timestamp, zidx, resolution, update=False, neariso=False):
@@ -48,7 +54,7 @@ class KVIO(object):
     return NotImplemented
 
   @abstractmethod
-  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False):
+  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, update=False):
     """Retrieve multiple cubes from the database"""
     return NotImplemented
   
@@ -62,6 +68,72 @@ class KVIO(object):
     """Store multiple cubes into the database"""
     return NotImplemented
   
+  def getCubeVersions(self, ch, listoftimestamps, listofidxs, resolution, neariso=False):
+    """Versions of the stored cubes as {(zidx, timestamp): version} without reading the cube data.
+       Engines that cannot compute cubecache.version on the server return None and decoded cubes are not cached.
+       Called with an empty listofidxs on cold reads, which should not touch the store."""
+    return None
+
+  def getIndexes(self, ch, listofids, timestamp, resolution, update=False):
+    """Retrieve the indexes for many annotations. Returns {annid: indexstr} for the ids that have an index.
+       Engines that can fetch many keys in one round trip override this."""
+    indexes = {}
+    for annid in listofids:
+      indexstr = self.getIndex(ch, annid, timestamp, resolution, update)
+      if indexstr:
+        indexes[annid] = indexstr
+    return indexes
+
+  def putIndexes(self, ch, timestamp, resolution, listofindexes):
+    """Store the indexes for many annotations. listofindexes holds (annid, indexstr, update).
+       Engines that can write many keys in one round trip override this."""
+    for annid, indexstr, update in listofindexes:
+      self.putIndex(ch, annid, timestamp, resolution, indexstr, update)
+  
+  def hasCubeLabels(self, ch, resolution):
+    """True if the engine keeps the labels of each cube. Otherwise label queries scan the voxel data."""
+    return False
+
+  def getCubeLabels(self, ch, listofidxs, timestamp, resolution, update=False):
+    """Retrieve the labels stored for many cubes as {zidx: labelstr}. Nothing is stored unless hasCubeLabels."""
+    return {}
+
+  def putCubeLabels(self, ch, timestamp, resolution, listoflabels):
+    """Store the labels for many cubes. Nothing is stored unless hasCubeLabels."""
+    pass
+
+  def createCubeLabels(self, ch, resolution):
+    """Create the storage for the labels of each cube"""
+    raise SpatialDBError("The {} engine does not keep the labels of each cube.".format(self.db.KVENGINE))
+
+  def getCubeKeys(self, ch, resolution):
+    """Every stored (zidx, timestamp)"""
+    raise SpatialDBError("The {} engine cannot list its cubes.".format(self.db.KVENGINE))
+
+  def getExceptionsList(self, ch, listofidxs, timestamp, resolution, listofids=None, update=False):
+    """Retrieve the exceptions for every pair of zindex and annotation id. Returns (zindex, id, exlist) for the pairs that have exceptions.
+       Engines that can fetch many keys in one round trip override this. Engines that cannot list ids need listofids."""
+    if listofids is None:
+      raise SpatialDBError("The {} engine cannot list the exceptions of a cube.".format(self.db.KVENGINE))
+    rows = []
+    for zidx, annid in itertools.product(listofidxs, listofids):
+      excstr = self.getExceptions(ch, zidx, timestamp, resolution, annid)
+      if excstr:
+        rows.append ( (zidx, annid, excstr) )
+    return rows
+
+  def getExceptions(self, ch, zidx, timestamp, resolution, annid):
+    """Retrieve the exceptions of one annotation id in a cube"""
+    raise SpatialDBError("The {} engine does not store exceptions.".format(self.db.KVENGINE))
+
+  def putExceptionsList(self, ch, timestamp, resolution, listofexceptions):
+    """Store exceptions for many cubes and ids. listofexceptions holds (zindex, id, exlist)."""
+    raise SpatialDBError("The {} engine does not store exceptions.".format(self.db.KVENGINE))
+
+  def deleteExceptionsList(self, ch, listofidxs, timestamp, resolution, listofids):
+    """Delete the exceptions for every pair of zindex and annotation id"""
+    raise SpatialDBError("The {} engine does not store exceptions.".format(self.db.KVENGINE))
+
   # Factory method for KVIO Engine
   @staticmethod
   def KVIOFactory(db):
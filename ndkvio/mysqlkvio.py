@@ -13,8 +13,16 @@
 # limitations under the License.
 
 import itertools
+import threading
+import Queue
+import numpy as np
 import MySQLdb
+import MySQLdb.cursors
+from django.conf import settings
 from kvio import KVIO
+from mysqlpool import MySQLPool
+from spdb import zindex
+from spdb import cubecache
 from ndtype import OLDCHANNEL
 from spatialdberror import SpatialDBError
 import logging
@@ -23,6 +31,11 @@ logger=logging.getLogger("neurodata")
 
 #RBTODO fix transaction support for putcubes
 
+# number of zindexes in a single getCubes query
+GETCUBES_CHUNK = 1024
+# number of fetched rows that may wait for the consumer
+GETCUBES_PREFETCH = 64
+
 
 """Helpers function to do cube I/O in across multiple DBs.
     This uses the state and methods of spatialdb"""
@@ -35,9 +48,9 @@ class MySQLKVIO(KVIO):
     self.db = db
     self.conn = None
     
-    # Connection info 
+    # Connection info. Borrow a connection from the process wide pool.
     try:
-      self.conn = MySQLdb.connect (host = self.db.proj.host, user = self.db.proj.kvengine_user, passwd = self.db.proj.kvengine_password, db = self.db.proj.dbname)
+      self.conn = MySQLPool().getConnection (host = self.db.proj.host, user = self.db.proj.kvengine_user, passwd = self.db.proj.kvengine_password, db = self.db.proj.dbname)
 
     except MySQLdb.Error, e:
       self.conn = None
@@ -46,53 +59,132 @@ class MySQLKVIO(KVIO):
 
     # start with no cursor
     self.txncursor = None
+    # number of startTxn calls not yet matched by a commit. only the outermost commit commits.
+    self.txndepth = 0
+    # set by the rollback of an inner transaction. the outermost commit then rolls back.
+    self.rollbackonly = False
+    # cubes written in the open transaction, (table, zindex, timestamp) -> cubestr. flushed at the outermost commit.
+    self.cubebuffer = {}
+    self.cubebufferbytes = 0
+    # buffered bytes that force a flush before the commit
+    self.maxbufferbytes = getattr(settings, 'SPDB_TXN_BUFFER_BYTES', 256*1024*1024)
+
+    # read from the server on first use
+    self.max_allowed_packet = None
+    # label table -> whether it exists
+    self.labeltables = {}
   
   def __del__(self):
     """Close the database connection"""
     self.close()
 
   def close ( self ):
-    """Close the connection"""
+    """Return the connection to the pool"""
     if self.conn:
-      self.conn.close()
+      if self.txncursor:
+        self.txncursor.close()
+        self.txncursor = None
+      self.txndepth = 0
+      self.rollbackonly = False
+      self.cubebuffer = {}
+      self.cubebufferbytes = 0
+      MySQLPool().putConnection (self.conn, host = self.db.proj.host, user = self.db.proj.kvengine_user, db = self.db.proj.dbname)
+      self.conn = None
 
   def startTxn ( self ):
-    """Start a transaction.  Ensure database is in multi-statement mode."""
+    """Start a transaction.  Ensure database is in multi-statement mode.
+       Transactions nest, a batch client can open one around many writes and they are committed together."""
     
+    if self.txncursor:
+      self.txndepth += 1
+      return
+
     self.txncursor = self.conn.cursor()
     sql = "START TRANSACTION"
     self.txncursor.execute ( sql )
+    self.txndepth = 1
 
   def commit ( self ):
-    """Commit the transaction.  Moved out of del to make explicit.""" 
+    """Commit the transaction.  Moved out of del to make explicit. Inner commits of a nested transaction do nothing.
+       If an inner transaction was rolled back the whole transaction is rolled back and SpatialDBError is raised.""" 
 
     if self.txncursor:
+      self.txndepth -= 1
+      if self.txndepth > 0:
+        return
+      if self.rollbackonly:
+        self.rollback()
+        logger.error("Transaction rolled back. An inner transaction failed.")
+        raise SpatialDBError("Transaction rolled back. An inner transaction failed.")
+      try:
+        self.flushCubes()
+      except:
+        self.rollback()
+        raise
       self.conn.commit()
       self.txncursor.close()
       self.txncursor = None
 
   def rollback ( self ):
-    """Rollback the transaction.  To be called on exceptions."""
+    """Rollback the transaction.  To be called on exceptions.
+       Inside a nested transaction the outermost one is marked rollback only and stays open until its commit or rollback."""
 
-    if self.txncursor:
-      self.conn.rollback()
-      self.txncursor.close()
+    if self.txndepth > 1:
+      self.txndepth -= 1
+      self.rollbackonly = True
+      return
+
+    try:
+      if self.txncursor:
+        self.conn.rollback()
+        self.txncursor.close()
+    finally:
+      # buffered cubes were never written. reset even if the connection failed.
+      self.cubebuffer = {}
+      self.cubebufferbytes = 0
+      self.txndepth = 0
+      self.rollbackonly = False
       self.txncursor = None
+
+
+  def cubeTable ( self, ch, resolution, neariso=False ):
+    return ch.getNearIsoTable(resolution) if neariso else ch.getTable(resolution)
+
+  def flushCubes ( self ):
+    """Write the cubes buffered by the transaction with one batch of multi-row upserts per table.
+       The rows stay uncommitted until the outermost commit."""
+
+    tables = {}
+    for (table, zidx, timestamp), cubestr in self.cubebuffer.iteritems():
+      tables.setdefault ( table, [] ).append ( (zidx, timestamp, cubestr) )
+    self.cubebuffer = {}
+    self.cubebufferbytes = 0
+
+    for table, rows in tables.iteritems():
+      sql = "INSERT INTO {} (zindex, timestamp, cube) VALUES {{}} ON DUPLICATE KEY UPDATE cube=VALUES(cube)".format(table)
+      try:
+        # in key order, like the other batched writes
+        self.insertRows ( self.txncursor, sql, sorted(rows) )
+      except MySQLdb.Error, e:
+        logger.error("Error inserting cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+        raise SpatialDBError("Error inserting cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
   
 
   def getCube(self, ch, timestamp, zidx, resolution, update=False, neariso=False, direct=False):
     """Retrieve a cube from the database by token, resolution, and zidx"""
 
+    # a cube written in this transaction is read back from the buffer
+    table = self.cubeTable(ch, resolution, neariso)
+    if (table, int(zidx), int(timestamp)) in self.cubebuffer:
+      return self.cubebuffer[(table, int(zidx), int(timestamp))]
+
     # if in a TxN us the transaction cursor.  Otherwise create one.
     if self.txncursor is None:
       cursor = self.conn.cursor()
     else:
       cursor = self.txncursor
    
-    if not neariso:
-      sql = "SELECT cube FROM {} WHERE (zindex,timestamp) = ({},{})".format(ch.getTable(resolution), zidx, timestamp)
-    else:
-      sql = "SELECT cube FROM {} WHERE (zindex,timestamp) = ({},{})".format(ch.getNearIsoTable(resolution), zidx, timestamp)
+    sql = "SELECT cube FROM {} WHERE (zindex,timestamp) = ({},{})".format(table, zidx, timestamp)
 
     if update:
       sql += " FOR UPDATE"
@@ -116,97 +208,245 @@ class MySQLKVIO(KVIO):
       return row[0]
 
   
-  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False):
+  def rangeQuery ( self, table, listofidxs, listoftimestamps, column='cube' ):
+    """Build the select for a set of zindexes. Keys are coalesced into contiguous morton ranges,
+       single keys go in an IN list and runs become range scans on the primary key."""
 
-    # if in a TxN us the transaction cursor.  Otherwise create one.
-    if self.txncursor is None:
-      cursor = self.conn.cursor()
-    else:
-      cursor = self.txncursor
-    
-    # creating a list of tuples (zindex, timestamp) and unrolling them for sql execution as [zindex, timestamp, zindex, timestamp]
-    index_list = list(itertools.chain.from_iterable(itertools.product(listofidxs, listoftimestamps)))
+    ranges = zindex.mortonRanges(listofidxs)
+    singles = [ low for (low, high) in ranges if low == high ]
+    runs = [ (low, high) for (low, high) in ranges if low != high ]
+
+    conditions = []
+    args = []
+    if singles:
+      conditions.append ( "zindex IN ({})".format(', '.join(['%s']*len(singles))) )
+      args += singles
+    for (low, high) in runs:
+      conditions.append ( "zindex BETWEEN %s AND %s" )
+      args += [low, high]
+    args += listoftimestamps
+
+    sql = "SELECT zindex, timestamp, {} FROM {} WHERE ({}) AND timestamp IN ({})".format( column, table, ' OR '.join(conditions), ', '.join(['%s']*len(listoftimestamps)) )
+    return sql, args
+
+
+  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False, update=False):
+    """Retrieve multiple cubes. The keys are queried in bounded chunks and rows are streamed from the server
+       by a fetch thread that runs ahead of the consumer. Consume the generator before issuing other queries.
+       With update the rows are locked until the end of the transaction. Cubes written in the transaction come from the buffer."""
+
+    listofidxs = np.unique ( np.asarray ( listofidxs, dtype=np.uint64 ) )
+    if len(listofidxs) == 0 or not listoftimestamps:
+      return
 
     if neariso:
-      print "Fetching data from isotropic tables"
-      sql = "SELECT zindex, timestamp, cube FROM {} WHERE (zindex, timestamp) in (%s)".format( ch.getNearIsoTable(resolution) ) 
+      logger.debug("Fetching data from isotropic tables")
     else:
-      print "Fetching data from normal tables"
-      sql = "SELECT zindex, timestamp, cube FROM {} WHERE (zindex, timestamp) in (%s)".format( ch.getTable(resolution) ) 
+      logger.debug("Fetching data from normal tables")
+    table = self.cubeTable(ch, resolution, neariso)
+
+    # cubes written in this transaction are not read again. they were locked when they were first read.
+    buffered = set()
+    if self.cubebuffer:
+      for zidx in listofidxs.tolist():
+        for timestamp in listoftimestamps:
+          if (table, zidx, int(timestamp)) in self.cubebuffer:
+            buffered.add ( (zidx, int(timestamp)) )
+            yield ( zidx, timestamp, self.cubebuffer[(table, zidx, int(timestamp))] )
+      # keys that are buffered at every timestamp are not queried
+      done = [ zidx for zidx in listofidxs.tolist() if all ( [ (zidx, int(timestamp)) in buffered for timestamp in listoftimestamps ] ) ]
+      listofidxs = np.setdiff1d ( listofidxs, np.array ( done, dtype=np.uint64 ) )
+      if len(listofidxs) == 0:
+        return
+
+    rows = Queue.Queue ( maxsize=GETCUBES_PREFETCH )
+    stop = threading.Event()
+
+    def fetchRows ():
+      """Run the chunked queries and queue the rows. A None marks the end."""
+
+      # an unbuffered cursor on the same connection, so that it shares any open transaction
+      cursor = self.conn.cursor ( MySQLdb.cursors.SSCursor )
+      sql = None
+      try:
+        for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+          sql, args = self.rangeQuery ( table, listofidxs[start:start+GETCUBES_CHUNK].tolist(), listoftimestamps )
+          if update:
+            sql += " FOR UPDATE"
+          cursor.execute ( sql, args )
+          for row in iter ( cursor.fetchone, None ):
+            if stop.is_set():
+              return
+            rows.put ( row )
+      except MySQLdb.Error, e:
+        logger.error("Failed to retrieve data cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+        rows.put ( SpatialDBError("Failed to retrieve data cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql)) )
+      except Exception, e:
+        logger.exception("Failed to retrieve data cubes")
+        rows.put ( SpatialDBError("Failed to retrieve data cubes: {}".format(e)) )
+      finally:
+        # closing the cursor discards any unread rows
+        cursor.close()
+        rows.put ( None )
 
-    # creats a %s for each list element
-    in_p=', '.join(map(lambda x: '(%s,%s)', [1]*(len(index_list)/2)))
-    # replace the single %s with the in_p string
-    sql = sql % in_p
+    fetcher = threading.Thread ( target=fetchRows )
+    fetcher.daemon = True
+    fetcher.start()
 
     try:
-      rc = cursor.execute(sql, index_list)
-    
-      # Get the objects and add to the cube
-      while ( True ):
-        try: 
-          retval = cursor.fetchone() 
-        except:
-          break
-        if retval is not None:
-          yield ( retval )
-        else:
-          return
-    
-    except MySQLdb.Error, e:
-      logger.error("Failed to retrieve data cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
-      raise SpatialDBError("Failed to retrieve data cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
-
+      for row in iter ( rows.get, None ):
+        if isinstance ( row, SpatialDBError ):
+          raise row
+        if buffered and (int(row[0]), int(row[1])) in buffered:
+          continue
+        yield ( row )
 
     finally:
-      # close the local cursor if not in a transaction
-      if self.txncursor is None:
-        cursor.close()
+      # if the consumer stopped early, release the fetch thread and wait for it to let go of the connection
+      stop.set()
+      while fetcher.is_alive():
+        try:
+          rows.get ( timeout=0.1 )
+        except Queue.Empty:
+          pass
+      fetcher.join()
    
   
-  def putCube ( self, ch, timestamp, zidx, resolution, cubestr, update=False, neariso=False, direct=False):
-    """Store a cube from the annotation database"""
-    
+  def getCubeVersions ( self, ch, listoftimestamps, listofidxs, resolution, neariso=False ):
+    """The CRC32 and length of the stored cubes as {(zidx, timestamp): (crc, length)}.
+       Computed by the server so no cube data is sent. No query is issued for an empty listofidxs."""
+
+    listofidxs = np.unique ( np.asarray ( listofidxs, dtype=np.uint64 ) )
+    versions = {}
+    if len(listofidxs) == 0 or not listoftimestamps:
+      return versions
+
+    table = self.cubeTable(ch, resolution, neariso)
+
     # if in a TxN us the transaction cursor.  Otherwise create one.
     if self.txncursor is None:
       cursor = self.conn.cursor()
     else:
       cursor = self.txncursor
-    
+
+    sql = None
     try:
-      # we created a cube from zeros
-      if not update:
-        if not neariso:
-          print "Inserting data from normal tables"
-          sql = "INSERT INTO {} (zindex, timestamp, cube) VALUES (%s, %s, %s)".format(ch.getTable(resolution))
-        else:
-          print "Inserting data from isotropic tables"
-          sql = "INSERT INTO {} (zindex, timestamp, cube) VALUES (%s, %s, %s)".format(ch.getNearIsoTable(resolution))
-        # this uses a cursor defined in the caller (locking context): not beautiful, but needed for locking
-        cursor.execute ( sql, (zidx, timestamp, cubestr) ) 
-      
-      else:
-        if not neariso:
-          print "Updating data from normal tables"
-          sql = "UPDATE {} SET cube=(%s) WHERE (zindex,timestamp)=({},{})".format(ch.getTable(resolution), zidx, timestamp)
-        else:
-          print "Updating data from isotropic tables"
-          sql = "UPDATE {} SET cube=(%s) WHERE (zindex,timestamp)=({},{})".format(ch.getNearIsoTable(resolution), zidx, timestamp)
-        cursor.execute( sql, (cubestr,) )
-      
+      for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+        sql, args = self.rangeQuery ( table, listofidxs[start:start+GETCUBES_CHUNK].tolist(), listoftimestamps, column='CRC32(cube), LENGTH(cube)' )
+        cursor.execute ( sql, args )
+        for zidx, timestamp, crc, length in cursor.fetchall():
+          versions[(int(zidx), int(timestamp))] = ( int(crc), int(length) )
+
     except MySQLdb.Error, e:
-      logger.error("Error updating/inserting cube: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
-      raise SpatialDBError("Error updating/inserting cube: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
-    
-    finally:
+      logger.error("Failed to retrieve cube versions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Failed to retrieve cube versions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
 
+    finally:
       # close the local cursor if not in a transaction
       if self.txncursor is None:
         cursor.close()
-
-        # commit if not in a txn
         self.conn.commit()
 
+    # cubes written in this transaction are not in the table yet
+    if self.cubebuffer:
+      wanted = set ( listofidxs.tolist() )
+      for timestamp in listoftimestamps:
+        for zidx in wanted:
+          cubestr = self.cubebuffer.get ( (table, zidx, int(timestamp)) )
+          if cubestr is not None:
+            versions[(zidx, int(timestamp))] = cubecache.version ( cubestr )
+
+    return versions
+
+
+  def maxAllowedPacket ( self ):
+    """The largest statement the server accepts. Read once per connection."""
+
+    if self.max_allowed_packet is None:
+
+      cursor = self.conn.cursor()
+      sql = "SELECT @@max_allowed_packet"
+      try:
+        cursor.execute ( sql )
+        self.max_allowed_packet = int(cursor.fetchone()[0])
+      except MySQLdb.Error, e:
+        logger.error("Failed to read max_allowed_packet: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+        raise SpatialDBError("Failed to read max_allowed_packet: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      finally:
+        cursor.close()
+
+    return self.max_allowed_packet
+
+
+  def insertRows ( self, cursor, sql, rows ):
+    """Execute a multi-row insert. The {} in sql is replaced by the row values.
+       Rows are split across statements so that each one fits in max_allowed_packet."""
+
+    if not rows:
+      return
+
+    placeholder = "({})".format(', '.join(['%s']*len(rows[0])))
+    # escaping can double binary data in the worst case
+    budget = self.maxAllowedPacket()/2 - len(sql)
+
+    start = 0
+    while start < len(rows):
+
+      # grow the batch until the next row would not fit. a row that is too large on its own is sent by itself.
+      end = start
+      size = 0
+      while end < len(rows):
+        rowsize = sum([ len(value) if isinstance(value, basestring) else 24 for value in rows[end] ]) + len(placeholder)
+        if end > start and size+rowsize > budget:
+          break
+        size += rowsize
+        end += 1
+
+      cursor.execute ( sql.format(', '.join([placeholder]*(end-start))), list(itertools.chain.from_iterable(rows[start:end])) )
+      start = end
+
+
+  def putCube ( self, ch, timestamp, zidx, resolution, cubestr, update=False, neariso=False, direct=False):
+    """Store a cube from the annotation database. The cube is inserted or replaced, update is ignored."""
+    
+    self.putCubes ( ch, [timestamp], [zidx], resolution, [cubestr], update=update, neariso=neariso )
+
+
+  def putCubes ( self, ch, listoftimestamps, listofidxs, resolution, listofcubes, update=False, neariso=False, direct=False):
+    """Store multiple cubes. Cubes are ordered by timestamp and then zindex.
+       Cubes are inserted or replaced with multi-row statements, update is ignored.
+       In a transaction the cubes are buffered until commit and repeated writes of a cube collapse into one."""
+
+    table = self.cubeTable(ch, resolution, neariso)
+
+    # match the (timestamp, zindex) ordering of the other engines
+    rows = [ (zidx, timestamp, cubestr) for (timestamp, zidx), cubestr in zip(itertools.product(listoftimestamps, listofidxs), listofcubes) ]
+
+    if self.txncursor is not None:
+      for zidx, timestamp, cubestr in rows:
+        old = self.cubebuffer.get ( (table, int(zidx), int(timestamp)) )
+        self.cubebufferbytes += len(cubestr or '') - len(old or '')
+        self.cubebuffer[(table, int(zidx), int(timestamp))] = cubestr
+      # bound the memory of a long transaction. the rows stay uncommitted until the outermost commit.
+      if self.cubebufferbytes > self.maxbufferbytes:
+        self.flushCubes()
+      return
+
+    cursor = self.conn.cursor()
+    sql = "INSERT INTO {} (zindex, timestamp, cube) VALUES {{}} ON DUPLICATE KEY UPDATE cube=VALUES(cube)".format(table)
+
+    try:
+      self.insertRows ( cursor, sql, rows )
+
+    except MySQLdb.Error, e:
+      logger.error("Error inserting cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error inserting cubes: {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      cursor.close()
+      # commit if not in a txn
+      self.conn.commit()
+
 
   def getIndex ( self, ch, annid, timestamp, resolution, update ):
     """MySQL fetch index routine"""
@@ -299,6 +539,182 @@ class MySQLKVIO(KVIO):
       self.conn.commit()
 
 
+  def getIndexes ( self, ch, listofids, timestamp, resolution, update=False ):
+    """Fetch the indexes for many annotations in one query per chunk. Returns {annid: indexstr}."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    indexes = {}
+    sql = None
+    try:
+      for start in range ( 0, len(listofids), GETCUBES_CHUNK ):
+        chunk = list(listofids[start:start+GETCUBES_CHUNK])
+        sql = "SELECT annid, cube FROM {} WHERE timestamp = %s AND annid IN ({})".format( ch.getIdxTable(resolution), ', '.join(['%s']*len(chunk)) )
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, [timestamp] + chunk )
+        for annid, indexstr in cursor.fetchall():
+          indexes[int(annid)] = indexstr
+    
+    except MySQLdb.Error, e:
+      logger.error("Failed to retrieve indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Failed to retrieve indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+    
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return indexes
+
+
+  def putIndexes ( self, ch, timestamp, resolution, listofindexes ):
+    """Store the indexes for many annotations with multi-row upserts. listofindexes holds (annid, indexstr, update)."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "INSERT INTO {} (annid, timestamp, cube) VALUES {{}} ON DUPLICATE KEY UPDATE cube=VALUES(cube)".format( ch.getIdxTable(resolution) )
+    try:
+      self.insertRows ( cursor, sql, [ (annid, timestamp, indexstr) for (annid, indexstr, update) in listofindexes ] )
+    
+    except MySQLdb.Error, e:
+      logger.error("Error updating indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error updating indexes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+    
+    finally:
+      # commit if not in a txn
+      if self.txncursor is None:
+        cursor.close()
+        self.conn.commit()
+
+
+  def getLabelTable ( self, ch, resolution ):
+    """Table of the labels in each cube. Columns zindex, timestamp and labels keyed on (zindex, timestamp)."""
+    return "{}_labels".format ( ch.getIdxTable(resolution) )
+
+
+  def hasCubeLabels ( self, ch, resolution ):
+    """True if the label table exists. Projects created before it was added have none until createCubeLabels."""
+
+    table = self.getLabelTable(ch, resolution)
+    if table not in self.labeltables:
+
+      cursor = self.conn.cursor()
+      sql = "SHOW TABLES LIKE %s"
+      try:
+        cursor.execute ( sql, [table] )
+        self.labeltables[table] = cursor.fetchone() is not None
+      except MySQLdb.Error, e:
+        logger.error("Failed to check for the label table {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+        raise SpatialDBError("Failed to check for the label table {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      finally:
+        cursor.close()
+
+    return self.labeltables[table]
+
+
+  def createCubeLabels ( self, ch, resolution ):
+    """Create the label table of a resolution if it does not exist. DDL commits implicitly so this cannot run in a transaction."""
+
+    if self.txncursor is not None:
+      logger.error("Cannot create the label table inside a transaction.")
+      raise SpatialDBError("Cannot create the label table inside a transaction.")
+
+    cursor = self.conn.cursor()
+    sql = "CREATE TABLE IF NOT EXISTS {} ( zindex BIGINT UNSIGNED NOT NULL, timestamp INT NOT NULL DEFAULT 0, labels LONGBLOB, PRIMARY KEY (zindex, timestamp) )".format( self.getLabelTable(ch, resolution) )
+    try:
+      cursor.execute ( sql )
+    except MySQLdb.Error, e:
+      logger.error("Failed to create the label table {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Failed to create the label table {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+    finally:
+      cursor.close()
+
+    self.labeltables[self.getLabelTable(ch, resolution)] = True
+
+
+  def getCubeKeys ( self, ch, resolution ):
+    """Every stored (zidx, timestamp) of a resolution in key order. Reads the primary key only."""
+
+    cursor = self.conn.cursor() if self.txncursor is None else self.txncursor
+    sql = "SELECT zindex, timestamp FROM {} ORDER BY zindex, timestamp".format( ch.getTable(resolution) )
+    try:
+      cursor.execute ( sql )
+      keys = [ (int(zidx), int(timestamp)) for (zidx, timestamp) in cursor.fetchall() ]
+    except MySQLdb.Error, e:
+      logger.error("Failed to list cubes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Failed to list cubes {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+    finally:
+      if self.txncursor is None:
+        cursor.close()
+
+    return keys
+
+
+  def getCubeLabels ( self, ch, listofidxs, timestamp, resolution, update=False ):
+    """Fetch the labels stored for many cubes. Returns {zidx: labelstr} for the cubes that have labels."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    cubelabels = {}
+    sql = None
+    try:
+      for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+        sql, args = self.rangeQuery ( self.getLabelTable(ch, resolution), listofidxs[start:start+GETCUBES_CHUNK], [timestamp], column='labels' )
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, args )
+        for zidx, ts, labelstr in cursor.fetchall():
+          cubelabels[int(zidx)] = labelstr
+
+    except MySQLdb.Error, e:
+      logger.error("Failed to retrieve cube labels {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Failed to retrieve cube labels {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return cubelabels
+
+
+  def putCubeLabels ( self, ch, timestamp, resolution, listoflabels ):
+    """Store the labels for many cubes. listoflabels holds (zidx, labelstr)."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = "INSERT INTO {} (zindex, timestamp, labels) VALUES {{}} ON DUPLICATE KEY UPDATE labels=VALUES(labels)".format( self.getLabelTable(ch, resolution) )
+    try:
+      self.insertRows ( cursor, sql, [ (zidx, timestamp, labelstr) for (zidx, labelstr) in listoflabels ] )
+
+    except MySQLdb.Error, e:
+      logger.error("Error inserting cube labels {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error inserting cube labels {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      # commit if not in a txn
+      if self.txncursor is None:
+        cursor.close()
+        self.conn.commit()
+
+
   def deleteIndex ( self, ch, annid, resolution ):
     """MySQL update index routine"""
 
@@ -428,3 +844,110 @@ class MySQLKVIO(KVIO):
     if self.txncursor is None:
       self.conn.commit()
       cursor.close()
+
+
+  def getExceptionsList ( self, ch, listofidxs, timestamp, resolution, listofids=None, update=False ):
+    """Load the exceptions for every pair of zindex and annotation id in one pass. All ids if listofids is None.
+       Returns (zindex, id, exlist) for the pairs that have exceptions."""
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    rows = []
+    sql = None
+    try:
+      for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+        chunk = list(listofidxs[start:start+GETCUBES_CHUNK])
+        sql = "SELECT zindex, id, exlist FROM {} WHERE timestamp=%s AND zindex IN ({})".format( ch.getExceptionsTable(resolution), ', '.join(['%s']*len(chunk)) )
+        args = [timestamp] + chunk
+        if listofids is not None:
+          sql += " AND id IN ({})".format( ', '.join(['%s']*len(listofids)) )
+          args += list(listofids)
+        if update:
+          sql += " FOR UPDATE"
+        cursor.execute ( sql, args )
+        rows.extend ( cursor.fetchall() )
+
+    except MySQLdb.Error, e:
+      logger.error("Error reading exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error reading exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      # close the local cursor if not in a transaction
+      if self.txncursor is None:
+        cursor.close()
+
+    return rows
+
+
+  def deleteExceptionsList ( self, ch, listofidxs, timestamp, resolution, listofids ):
+    """Delete the exceptions for every pair of zindex and annotation id"""
+
+    if len(listofidxs) == 0 or len(listofids) == 0:
+      return
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    sql = None
+    try:
+      for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+        chunk = list(listofidxs[start:start+GETCUBES_CHUNK])
+        sql = "DELETE FROM {} WHERE timestamp=%s AND zindex IN ({}) AND id IN ({})".format( ch.getExceptionsTable(resolution), ', '.join(['%s']*len(chunk)), ', '.join(['%s']*len(listofids)) )
+        cursor.execute ( sql, [timestamp] + chunk + list(listofids) )
+
+    except MySQLdb.Error, e:
+      logger.error("Error deleting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error deleting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      # commit if not in a txn
+      if self.txncursor is None:
+        cursor.close()
+        self.conn.commit()
+
+
+  def putExceptionsList ( self, ch, timestamp, resolution, listofexceptions ):
+    """Store exceptions for many cubes and ids. listofexceptions holds (zindex, id, exlist). Existing lists are replaced.
+       The old rows are deleted and the new ones inserted, the exceptions table need not have a unique key."""
+
+    if not listofexceptions:
+      return
+
+    # if in a TxN us the transaction cursor.  Otherwise create one.
+    if self.txncursor is None:
+      cursor = self.conn.cursor()
+    else:
+      cursor = self.txncursor
+
+    # the cubes written for each id
+    cubeids = {}
+    for (zidx, annid, excstr) in listofexceptions:
+      cubeids.setdefault ( annid, [] ).append ( zidx )
+
+    sql = None
+    try:
+      for annid, listofidxs in cubeids.iteritems():
+        for start in range ( 0, len(listofidxs), GETCUBES_CHUNK ):
+          chunk = list(listofidxs[start:start+GETCUBES_CHUNK])
+          sql = "DELETE FROM {} WHERE timestamp=%s AND id=%s AND zindex IN ({})".format( ch.getExceptionsTable(resolution), ', '.join(['%s']*len(chunk)) )
+          cursor.execute ( sql, [timestamp, annid] + chunk )
+
+      sql = "INSERT INTO {} (zindex, timestamp, id, exlist) VALUES {{}}".format( ch.getExceptionsTable(resolution) )
+      self.insertRows ( cursor, sql, [ (zidx, timestamp, annid, excstr) for (zidx, annid, excstr) in listofexceptions ] )
+
+    except MySQLdb.Error, e:
+      logger.error("Error inserting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+      raise SpatialDBError("Error inserting exceptions {}: {}. sql={}".format(e.args[0], e.args[1], sql))
+
+    finally:
+      # commit if not in a txn
+      if self.txncursor is None:
+        cursor.close()
+        self.conn.commit()
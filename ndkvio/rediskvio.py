@@ -152,8 +152,8 @@ class RedisKVIO(KVIO):
     else:
       return None
   
-  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False):
-    """Retrieve multiple cubes from the database"""
+  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False, update=False):
+    """Retrieve multiple cubes from the database. There is no row locking so update is ignored."""
     if direct:
       return self.s3io.getCubes(ch, listoftimestamps, listofidxs, resolution, neariso=neariso)
     else:
@@ -90,7 +90,9 @@ class S3IO:
     # KL TODO This should be replaced by Blaze
     # KL TODO Remember to convert listofcubes into listofsupercubes, listofidxs into listofsuperidxs
     # basically an exact opposite of breakCubes() like combineCubes()
-    return NotImplemented
+    # for now the caller passes supercubes, so store them one object at a time
+    for (timestamp, super_zidx), cubestr in zip(itertools.product(listoftimestamps, listofidxs), listofcubes):
+      self.putCube(ch, timestamp, super_zidx, resolution, cubestr, update=update, neariso=neariso)
   
   def putCube ( self, ch, timestamp, zidx, resolution, cubestr, update=False, neariso=False):
     """Store a cube from the annotation database"""
@@ -19,11 +19,18 @@ import cStringIO
 import zlib
 from collections import defaultdict
 import itertools
+import collections
 import blosc
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
 from operator import add, sub, div, mod, mul
 from spdb.ndcube.cube import Cube
 from spdb.ndkvio.kvio import KVIO
+from spdb import zindex
+from spdb import exceptionrecord
+from spdb import cubecache
+from spdb import mortonbitmap
 import annindex
 from ndlib.ndctypelib import *
 from ndlib.ndtype import *
@@ -39,6 +46,9 @@ logger=logging.getLogger("neurodata")
 .. moduleauthor:: Kunal Lillaney <lillaney@jhu.edu>
 """
 
+# number of cubes decompressed per batch when the label table is rebuilt
+GETLABELS_CHUNK = 256
+
 class SpatialDB: 
 
   def __init__ (self, proj):
@@ -55,10 +65,22 @@ class SpatialDB:
     # self.mdio = MDIO.getEngine(self)
     self.annoIdx = annindex.AnnotateIndex ( self.kvio, self.proj )
 
+    # number of threads used to decompress and assemble cuboids
+    self.workers = getattr(settings, 'SPDB_WORKERS', 1)
+    # created on first use and reused by every read
+    self.pool = None
+
+    # decoded cubes shared by every SpatialDB in the process
+    self.cache = cubecache.CubeCache()
+
 
   def close ( self ):
     """Close the connection"""
 
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
     self.kvio.close()
 
 
@@ -72,76 +94,274 @@ class SpatialDB:
       cubedim = self.datasetcfg.get_cubedim(resolution)
     
     cube = Cube.CubeFactory(cubedim, ch.channel_type, ch.channel_datatype, time_range=[timestamp, timestamp+1])
-    cube.deserialize(self.kvio.getCube(ch, timestamp, zidx, resolution, update=update, neariso=neariso, direct=direct))
+
+    # reads that lock the cube always go to the store
+    versions = None
+    if not update and not direct:
+      versions = self.getCubeVersions(ch, [timestamp], [zidx], resolution, neariso=neariso)
+    key = self._cacheKey(ch, resolution, zidx, timestamp, neariso)
+
+    if versions and (int(zidx), int(timestamp)) in versions:
+      data = self.cache.get(key, versions[(int(zidx), int(timestamp))])
+      if data is not None:
+        # the caller owns the cube so it gets a copy
+        cube.data = data.copy()
+        return cube
+
+    cubestr = self.kvio.getCube(ch, timestamp, zidx, resolution, update=update, neariso=neariso, direct=direct)
+    cube.deserialize(cubestr)
+    if versions is not None and cubestr:
+      self.cache.put(key, cube.data.copy(), cubecache.version(cubestr))
     return cube
     
   
-  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False):
+  def getCubes(self, ch, listoftimestamps, listofidxs, resolution, neariso=False, direct=False, update=False):
     """Return a list of cubes"""
-    return self.kvio.getCubes(ch, listoftimestamps, listofidxs, resolution, neariso=neariso, direct=direct)
+    return self.kvio.getCubes(ch, listoftimestamps, listofidxs, resolution, neariso=neariso, direct=direct, update=update)
    
 
   def putCubes(self, ch, listoftimestamps, listofidxs, resolution, listofcubes, update=False, neariso=False, direct=False):
     """Insert a list of cubes"""
+    self.cache.invalidate([ self._cacheKey(ch, resolution, zidx, timestamp, neariso) for timestamp in listoftimestamps for zidx in listofidxs ])
     return self.kvio.putCubes(ch, listoftimestamps, listofidxs, resolution, listofcubes, update=update, neariso=neariso, direct=direct)
  
 
   def putCube(self, ch, timestamp, zidx, resolution, cube, update=False, neariso=False, direct=False):
     """Insert a cube in the database"""
+    self.cache.invalidate([ self._cacheKey(ch, resolution, zidx, timestamp, neariso) ])
     return self.kvio.putCube(ch, timestamp, zidx, resolution, cube.serialize(), not cube.fromZeros(), neariso=neariso, direct=direct)
+
+
+  def _cacheKey(self, ch, resolution, zidx, timestamp, neariso):
+    return (self.proj.project_name, ch.channel_name, resolution, int(zidx), int(timestamp), bool(neariso))
+
+
+  def getCubeVersions(self, ch, listoftimestamps, listofidxs, resolution, neariso=False):
+    """Versions of the stored cubes that are in the cache as {(zidx, timestamp): version}. Cold reads issue no query.
+       None if the cube cache is off or the engine cannot tell, in which case nothing is read from or added to the cache."""
+
+    if not self.cache.enabled():
+      return None
+
+    # only indexes with a cached timestamp are checked against the store
+    keys = dict ( [ (self._cacheKey(ch, resolution, zidx, ts, neariso), int(zidx)) for zidx in listofidxs for ts in listoftimestamps ] )
+    cachedidxs = sorted ( set ( [ keys[key] for key in self.cache.cached(keys.keys()) ] ) )
+    return self.kvio.getCubeVersions(ch, listoftimestamps, cachedidxs, resolution, neariso=neariso)
     
 
   def getExceptions(self, ch, zidx, timestamp, resolution, annoid):
-    """Load a cube from the annotation database"""
+    """Load the exceptions of an annotation in a cube as an (N,3) array of x,y,z"""
 
-    excstr = self.kvio.getExceptions(ch, zidx, timestamp, resolution, annoid)
-    if excstr:
-      return blosc.unpack_array(excstr)
+    keys = self.readExceptions(ch, [zidx], timestamp, resolution, [annoid]).get(int(zidx), [])
+    if len(keys) != 0:
+      return exceptionrecord.fromKeys(keys)[0][1]
     else:
       return []
 
+
+  def _exceptionRows(self, ch, listofidxs, timestamp, resolution, listofids=None, update=False):
+    """Exception keys of many cubes as {zidx: sorted keys} and the ids of the legacy rows that were read.
+       Consolidated records and legacy rows with one id each are merged."""
+
+    # the consolidated record is always read along with the ids
+    if listofids is not None:
+      listofids = [exceptionrecord.RECORD_ID] + [ int(annid) for annid in listofids ]
+
+    cubekeys = defaultdict(list)
+    legacyids = set()
+    for zidx, exid, excstr in self.kvio.getExceptionsList(ch, [ int(zidx) for zidx in listofidxs ], timestamp, resolution, listofids, update):
+      if exceptionrecord.isRecord(excstr):
+        cubekeys[int(zidx)].append ( exceptionrecord.unpack(excstr) )
+      else:
+        cubekeys[int(zidx)].append ( exceptionrecord.toKeys(exid, blosc.unpack_array(excstr)) )
+        legacyids.add ( int(exid) )
+
+    return dict ( [ (zidx, np.unique(np.concatenate(keys))) for zidx, keys in cubekeys.iteritems() ] ), legacyids
+
+
+  def readExceptions(self, ch, listofidxs, timestamp, resolution, listofids=None, update=False):
+    """Load the exceptions of many cubes in one query as {zidx: sorted keys}. All ids if listofids is None.
+       Use exceptionrecord.fromKeys to get the voxels of each id."""
+
+    cubekeys, legacyids = self._exceptionRows(ch, listofidxs, timestamp, resolution, listofids, update)
+    if listofids is not None:
+      for zidx in cubekeys:
+        cubekeys[zidx] = exceptionrecord.selectIds ( cubekeys[zidx], listofids )
+    return cubekeys
+
+
+  def rewriteExceptions(self, ch, timestamp, resolution, listofidxs, rewrite):
+    """Lock the exceptions of many cubes and replace them with rewrite(zidx, keys).
+       Each cube is written back as one consolidated record and its legacy rows are removed. Should be done in a transaction.
+       Returns {zidx: keys} with the new record of every cube."""
+
+    listofidxs = sorted ( set ( [ int(zidx) for zidx in listofidxs ] ) )
+    if not listofidxs:
+      return {}
+
+    # read every id so that the legacy rows can be folded in
+    cubekeys, legacyids = self._exceptionRows(ch, listofidxs, timestamp, resolution, None, update=True)
+
+    listofrecords = []
+    emptyidxs = []
+    newkeys = {}
+    for zidx in listofidxs:
+      keys = newkeys[zidx] = rewrite ( zidx, cubekeys.get(zidx, np.empty(0, dtype=np.uint64)) )
+      if len(keys) != 0:
+        listofrecords.append ( (zidx, exceptionrecord.RECORD_ID, exceptionrecord.pack(keys)) )
+      else:
+        emptyidxs.append ( zidx )
+
+    self.kvio.deleteExceptionsList(ch, listofidxs, timestamp, resolution, sorted(legacyids))
+    self.kvio.deleteExceptionsList(ch, emptyidxs, timestamp, resolution, [exceptionrecord.RECORD_ID])
+    self.kvio.putExceptionsList(ch, timestamp, resolution, listofrecords)
+    return newkeys
+
+
+  def _exceptionKeys(self, cubeexceptions):
+    """Group {(zidx, exid): voxels} into {zidx: sorted keys}"""
+
+    newkeys = defaultdict(list)
+    for (zidx, exid), exceptions in cubeexceptions.iteritems():
+      newkeys[int(zidx)].append ( exceptionrecord.toKeys(exid, exceptions) )
+    return dict ( [ (zidx, np.unique(np.concatenate(keys))) for zidx, keys in newkeys.iteritems() ] )
+
   
   def updateExceptions(self, ch, key, timestamp, resolution, exid, exceptions, update=False):
     """Merge new exceptions with existing exceptions"""
 
-    curexlist = self.getExceptions(ch, key, timestamp, resolution, exid) 
+    self.updateExceptionsList ( ch, timestamp, resolution, { (key, exid): exceptions } )
 
-    update = False
 
-    if curexlist!=[]:
-      oldexlist = [ XYZMorton ( trpl ) for trpl in curexlist ]
-      newexlist = [ XYZMorton ( trpl ) for trpl in exceptions ]
-      exlist = set(newexlist + oldexlist)
-      exlist = [ MortonXYZ ( zidx ) for zidx in exlist ]
-      update = True
-    else:
-      exlist = exceptions
+  def updateExceptionsList(self, ch, timestamp, resolution, cubeexceptions):
+    """Merge new exceptions with existing exceptions for many cubes at once.
+       cubeexceptions maps (zidx, exid) to a list of voxel triples. Returns the new records as rewriteExceptions."""
+
+    if not cubeexceptions:
+      return {}
 
-    self.putExceptions ( ch, key, timestamp, resolution, exid, exlist, update)
+    newkeys = self._exceptionKeys(cubeexceptions)
+    return self.rewriteExceptions ( ch, timestamp, resolution, newkeys.keys(), lambda zidx, keys: np.union1d(keys, newkeys[zidx]) )
 
 
   def putExceptions(self, ch, key, timestamp, resolution, exid, exceptions, update):
-    """Package the object and transact with kvio"""
-    
-    exceptions = np.array ( exceptions, dtype=np.uint32 )
+    """Replace the exceptions of an annotation in a cube"""
     
-    # insert exceptions
-    self.kvio.putExceptions(ch, key, timestamp, resolution, exid, blosc.pack_array(exceptions), update)
+    newkeys = exceptionrecord.toKeys(exid, exceptions)
+    self.rewriteExceptions ( ch, timestamp, resolution, [key], lambda zidx, keys: np.union1d(keys[(keys >> np.uint64(32)) != exid], newkeys) )
 
 
   def removeExceptions(self, ch, key, timestamp, resolution, entityid, exceptions):
     """Remove a list of exceptions. Should be done in a transaction"""
 
-    curexlist = self.getExceptions(ch, key, timestamp, resolution, entityid) 
+    self.removeExceptionsList ( ch, timestamp, resolution, { (key, entityid): exceptions } )
+
+
+  def removeExceptionsList(self, ch, timestamp, resolution, cubeexceptions):
+    """Remove exceptions from many cubes at once. cubeexceptions maps (zidx, exid) to a list of voxel triples.
+       Returns the new records as rewriteExceptions."""
+
+    if not cubeexceptions:
+      return {}
+
+    oldkeys = self._exceptionKeys(cubeexceptions)
+    return self.rewriteExceptions ( ch, timestamp, resolution, oldkeys.keys(), lambda zidx, keys: np.setdiff1d(keys, oldkeys[zidx], assume_unique=True) )
+
+
+  def deleteExceptionIds(self, ch, listofidxs, timestamp, resolution, listofids):
+    """Remove every exception of the annotation ids from many cubes. Returns the new records as rewriteExceptions."""
 
-    if curexlist != []:
+    listofids = np.asarray ( listofids, dtype=np.uint64 )
+    return self.rewriteExceptions ( ch, timestamp, resolution, listofidxs, lambda zidx, keys: keys[~np.in1d(keys >> np.uint64(32), listofids)] )
 
-      oldexlist = set([ XYZMorton ( trpl ) for trpl in curexlist ])
-      newexlist = set([ XYZMorton ( trpl ) for trpl in exceptions ])
-      exlist = oldexlist-newexlist
-      exlist = [ MortonXYZ ( zidx ) for zidx in exlist ]
 
-      self.putExceptions ( ch, key, timestamp, resolution, exid, exlist, True )
+  def updateCubeLabels(self, ch, timestamp, resolution, cubelabels, cubekeys={}):
+    """Record the labels in many cubes in the reverse index. cubelabels maps zidx to the labels in the cube data.
+       With exceptions the ids in each cube's exception record are added, a label can remain in a cube as an exception only.
+       cubekeys holds records the caller already has as {zidx: keys}, the others are read."""
+
+    # projects without a label table keep working, getLabels scans the voxels instead
+    if not cubelabels or not self.kvio.hasCubeLabels(ch, resolution):
+      return
+
+    if ch.getExceptions() == EXCEPTION_TRUE:
+      cubekeys = dict(cubekeys)
+      missing = [ zidx for zidx in cubelabels if int(zidx) not in cubekeys ]
+      if missing:
+        cubekeys.update ( dict.fromkeys ( [ int(zidx) for zidx in missing ], np.empty(0, dtype=np.uint64) ) )
+        cubekeys.update ( self.readExceptions(ch, missing, timestamp, resolution) )
+      for zidx in cubelabels:
+        cubelabels[zidx] = np.union1d ( cubelabels[zidx], cubekeys[int(zidx)] >> np.uint64(32) )
+
+    listoflabels = []
+    for zidx, labels in cubelabels.iteritems():
+      # no reason to index 0
+      labels = labels[labels != 0].astype(np.uint32)
+      listoflabels.append ( (zidx, blosc.pack_array(labels)) )
+
+    self.kvio.putCubeLabels(ch, timestamp, resolution, listoflabels)
+
+
+  def getLabels(self, ch, corner, dim, resolution, timestamp=0):
+    """Return the labels in the cubes that intersect a region. Reads the reverse index, no voxel data.
+       Without a label table the cubes are cut out and scanned."""
+
+    cubedim = self.datasetcfg.get_cubedim(resolution)
+
+    # round to the nearest larger cube in all dimensions
+    start = map(div, corner, cubedim)
+    numcubes = [ (corner[i]+dim[i]+cubedim[i]-1)/cubedim[i] - start[i] for i in range(3) ]
+
+    listofidxs = np.sort ( zindex.cubeKeys(start, numcubes), axis=None ).tolist()
+
+    if self.kvio.hasCubeLabels(ch, resolution):
+      labels = [ blosc.unpack_array(labelstr) for labelstr in self.kvio.getCubeLabels(ch, listofidxs, timestamp, resolution).itervalues() ]
+    else:
+      cube = self.cutout(ch, map(mul, start, cubedim), map(mul, numcubes, cubedim), resolution, [timestamp, timestamp+1])
+      labels = [ np.unique(cube.data).astype(np.uint32) ]
+      # labels held as exceptions only
+      if ch.getExceptions() == EXCEPTION_TRUE:
+        labels += [ ( keys >> np.uint64(32) ).astype(np.uint32) for keys in self.readExceptions(ch, listofidxs, timestamp, resolution).itervalues() ]
+
+    labels = np.unique ( np.concatenate ( [np.empty(0, dtype=np.uint32)] + labels ) )
+    return labels[labels != 0]
+
+
+  def buildCubeLabels(self, ch, resolution):
+    """Create and fill the label table of a resolution from the stored cubes and exceptions.
+       Migration for projects written before the table existed. Run it while the channel is not being written."""
+
+    self.kvio.createCubeLabels(ch, resolution)
+
+    cubekeys = defaultdict(list)
+    for zidx, timestamp in self.kvio.getCubeKeys(ch, resolution):
+      cubekeys[timestamp].append(zidx)
+
+    for timestamp, listofidxs in cubekeys.iteritems():
+      for first in range(0, len(listofidxs), GETLABELS_CHUNK):
+        chunk = listofidxs[first:first+GETLABELS_CHUNK]
+
+        cubelabels = {}
+        with closing(self.getCubes(ch, [timestamp], chunk, resolution)) as cuboids:
+          for idx, ts, datastring in cuboids:
+            if datastring:
+              cubelabels[int(idx)] = np.unique(Cube.unpack(datastring))
+
+        # labels held as exceptions only
+        cubekeys = {}
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          cubekeys = dict.fromkeys ( [ int(idx) for idx in chunk ], np.empty(0, dtype=np.uint64) )
+          cubekeys.update ( self.readExceptions(ch, chunk, timestamp, resolution) )
+          for idx in cubekeys:
+            cubelabels.setdefault ( idx, np.empty(0, dtype=np.uint32) )
+
+        self.kvio.startTxn()
+        try:
+          self.updateCubeLabels(ch, timestamp, resolution, cubelabels, cubekeys)
+        except:
+          self.kvio.rollback()
+          raise
+        self.kvio.commit()
 
 
   def annotate(self, ch, entityid, timestamp, resolution, locations, conflictopt='O'):
@@ -152,8 +372,6 @@ class SpatialDB:
     # an item may exist across several cubes
     # convert the locations into Morton order
 
-    # dictionary with the index
-    cubeidx = defaultdict(set)
     cubelocs = locate_ctype ( np.array(locations, dtype=np.uint32), cubedim )
 
     # sort the arrary, by cubeloc
@@ -165,36 +383,75 @@ class SpatialDB:
     # then turn into a set of ranges of the same element
     listoffsets = np.r_[0, nzdiff + 1, len(cubelocs)]
 
+    # the morton key of every affected cube
+    listofidxs = cubelocs[listoffsets[:-1],0].tolist()
+    # get a voxel offset for each cube
+    listofoffsets = ( zindex.MortonXYZ(listofidxs) * np.array(cubedim, dtype=np.uint64) ).astype(np.uint32)
+
     # start a transaction if supported
     self.kvio.startTxn()
-    for i in range(len(listoffsets)-1):
 
-      # grab the list of voxels for the first cube
-      voxlist = cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4]
-      #  and the morton key
-      key = cubelocs[listoffsets[i],0]
+    try:
 
-      cube = self.getCube ( ch, timestamp, key, resolution, update=True )
+      # fetch and lock all the affected cubes in one query
+      cubestrs = {}
+      with closing(self.getCubes ( ch, [timestamp], listofidxs, resolution, update=True )) as cuboids:
+        for idx, ts, datastring in cuboids:
+          cubestrs[int(idx)] = datastring
+
+      listofcubes = []
+      cubeexceptions = {}
+      cubelabels = {}
+      # voxels that carry the label
+      labeled = []
+      # labels that were overwritten
+      lost = []
+      for i, key in enumerate(listofidxs):
+
+        # grab the list of voxels for the cube
+        voxlist = cubelocs[listoffsets[i]:listoffsets[i+1],:][:,1:4]
+        local = voxlist - listofoffsets[i]
 
-      # get a voxel offset for the cube
-      cubeoff = MortonXYZ( key )
-      offset = np.asarray([cubeoff[0]*cubedim[0], cubeoff[1]*cubedim[1], cubeoff[2]*cubedim[2]], dtype=np.uint32)
+        cube = Cube.CubeFactory ( cubedim, ch.channel_type, ch.channel_datatype, time_range=[timestamp, timestamp+1] )
+        cube.deserialize ( cubestrs.get(key) )
+        before = cube.data[0, local[:,2], local[:,1], local[:,0]]
 
-      # add the items
-      exceptions = np.array(cube.annotate(entityid, timestamp, offset, voxlist, conflictopt), dtype=np.uint8)
+        # add the items
+        exceptions = np.array(cube.annotate(entityid, timestamp, listofoffsets[i], voxlist, conflictopt), dtype=np.uint8)
 
-      # update the sparse list of exceptions
-      if ch.getExceptions() == EXCEPTION_TRUE:
-        if len(exceptions) != 0:
-          self.updateExceptions(ch, key, timestamp, resolution, entityid, exceptions)
+        # the voxels that were labeled. others were preserved or became exceptions.
+        after = cube.data[0, local[:,2], local[:,1], local[:,0]]
+        labeled.append ( voxlist [ after == entityid ] )
+        lost.append ( before [ (before != after) & (before != 0) ] )
+
+        # collect the sparse list of exceptions
+        cubelabels[key] = np.unique ( cube.data )
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          if len(exceptions) != 0:
+            cubeexceptions[(key, entityid)] = exceptions
+            labeled.append ( exceptions + listofoffsets[i] )
 
-      self.putCube(ch, timestamp, key, resolution, cube )
+        listofcubes.append ( cube.serialize() )
 
-      # add this cube to the index
-      cubeidx[entityid].add(key)
+      # write the exceptions and cubes back in batches
+      cubekeys = self.updateExceptionsList(ch, timestamp, resolution, cubeexceptions)
+      self.putCubes(ch, [timestamp], listofidxs, resolution, listofcubes, update=True)
+      self.updateCubeLabels(ch, timestamp, resolution, cubelabels, cubekeys)
+
+      # add the cubes and the bounding box of the labeled voxels to the index
+      labeled = np.concatenate ( labeled ).astype(np.int64)
+      boxes = { entityid: ( labeled.min(axis=0).tolist(), (labeled.max(axis=0)+1).tolist() ) } if len(labeled) else {}
+      self.annoIdx.updateIndexDense(ch, [entityid]*len(listofidxs), listofidxs, timestamp, resolution, boxes)
+
+      # overwritten labels may have shrunk
+      lost = np.unique ( np.concatenate ( lost ) )
+      if len(lost):
+        self.annoIdx.invalidateBoundingBoxes(ch, lost.tolist(), timestamp, resolution)
+
+    except:
+      self.kvio.rollback()
+      raise
 
-    # write it to the database
-    self.annoIdx.updateIndexDense(ch, cubeidx, timestamp, resolution)
     # commit cubes.  not commit controlled with metadata
     self.kvio.commit()
 
@@ -223,6 +480,7 @@ class SpatialDB:
 
     try:
 
+      cubelabels = {}
       for i in range(len(listoffsets)-1):
 
         # grab the list of voxels for the first cube
@@ -243,15 +501,20 @@ class SpatialDB:
         exceptions = np.array(exlist, dtype=np.uint8)
 
         # update the sparse list of exceptions
-        if ch.getExceptions == EXCEPTION_TRUE:
+        if ch.getExceptions() == EXCEPTION_TRUE:
           if len(exceptions) != 0:
             self.removeExceptions ( ch, key, timestamp, resolution, entityid, exceptions )
 
         self.putCube (ch, timestamp, key, resolution, cube)
+        cubelabels[key] = np.unique ( cube.data )
 
         # For now do no index processing when shaving.  Assume there are still some
         #  voxels in the cube???
 
+      self.updateCubeLabels(ch, timestamp, resolution, cubelabels)
+      # the bounding box may have shrunk
+      self.annoIdx.invalidateBoundingBoxes(ch, [entityid], timestamp, resolution)
+
     except:
       self.kvio.rollback()
       raise
@@ -262,8 +525,6 @@ class SpatialDB:
   def annotateDense ( self, ch, timestamp, corner, resolution, annodata, conflictopt='O', neariso=False ):
     """Process all the annotations in the dense volume"""
 
-    index_dict = defaultdict(set)
-
     # dim is in xyz, data is in zyxj
     dim = annodata.shape[::-1]
 
@@ -282,64 +543,58 @@ class SpatialDB:
     databuffer = np.zeros ([znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=np.uint32 )
     databuffer [ zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0] ] = annodata 
 
+    # morton keys of the cubes in z,y,x order
+    keys = zindex.cubeKeys ( start, [xnumcubes, ynumcubes, znumcubes] )
+
+    if conflictopt == 'O':
+      merge = lambda cube, data: cube.overwrite ( 0, data )
+    elif conflictopt == 'P':
+      merge = lambda cube, data: cube.preserve ( 0, data )
+    elif conflictopt == 'E': 
+      if ch.getExceptions() == EXCEPTION_TRUE:
+        merge = lambda cube, data: cube.exception ( 0, data )
+      else:
+        logger.error("No exceptions for this project.")
+        raise SpatialDBError ( "No exceptions for this project.")
+    else:
+      logger.error ( "Unsupported conflict option %s" % conflictopt )
+      raise SpatialDBError ( "Unsupported conflict option %s" % conflictopt )
+
     # start a transaction if supported
     self.kvio.startTxn()
 
     try:
 
-      for z in range(znumcubes):
-        for y in range(ynumcubes):
-          for x in range(xnumcubes):
-
-            key = XYZMorton ([x+xstart,y+ystart,z+zstart])
-            cube = self.getCube (ch, timestamp, key, resolution, update=True, neariso=neariso )
-            if cube.fromZeros():
-              update = False
-            else: 
-               update = True
-            
-            if conflictopt == 'O':
-              cube.overwrite ( 0, databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            elif conflictopt == 'P':
-              cube.preserve ( 0, databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            elif conflictopt == 'E': 
-              if ch.getExceptions() == EXCEPTION_TRUE:
-                exdata = cube.exception ( timestamp, databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-                for exid in np.unique ( exdata ):
-                  if exid != 0:
-                    # get the offsets
-                    exoffsets = np.nonzero ( exdata==exid )
-                    # assemble into 3-tuples zyx->xyz
-                    exceptions = np.array ( zip(exoffsets[2], exoffsets[1], exoffsets[0]), dtype=np.uint32 )
-                    # update the exceptions
-                    self.updateExceptions ( ch, key, timestamp, resolution, exid, exceptions )
-                    # add to the index
-                    index_dict[exid].add(key)
-              else:
-                logger.error("No exceptions for this project.")
-                raise SpatialDBError ( "No exceptions for this project.")
-            else:
-              logger.error ( "Unsupported conflict option %s" % conflictopt )
-              raise SpatialDBError ( "Unsupported conflict option %s" % conflictopt )
-            self.putCube (ch, timestamp, key, resolution, cube, update=update, neariso=neariso )
-
-            # RBTODO do we need to buiild neariso indexes or are they visual only?
-            if not neariso:
-
-              # update the index for the cube
-              # get the unique elements that are being added to the data
-              uniqueels = np.unique ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-              for el in uniqueels:
-                index_dict[el].add(key) 
-
-              # remove 0 no reason to index that
-              if 0 in index_dict:
-                del(index_dict[0])
-
-      # update all indexes
+      cuboids = self._mergeDense ( ch, timestamp, resolution, databuffer, keys, merge, neariso=neariso, boxes=not neariso )
 
+      # update the sparse list of exceptions
+      cubeexceptions = {}
+      cubelabels = {}
+      for key, (ce, cl, cb, cx) in cuboids.iteritems():
+        for exid, exlist in ce.iteritems():
+          cubeexceptions[(key, exid)] = exlist
+        cubelabels[key] = cl
+      cubekeys = self.updateExceptionsList ( ch, timestamp, resolution, cubeexceptions )
+
+      # RBTODO do we need to buiild neariso indexes or are they visual only?
       if not neariso:
-        self.annoIdx.updateIndexDense(ch, index_dict, timestamp, resolution )
+
+        # the labels in each cube
+        self.updateCubeLabels ( ch, timestamp, resolution, cubelabels, cubekeys )
+
+        # bounding box of each label over all the cubes
+        boxes = [ cb for (ce, cl, cb, cx) in cuboids.itervalues() ]
+        boxes = annindex.labelBoxes ( *[ np.concatenate(arrays) for arrays in zip(*boxes) ] )
+        boxes = dict ( zip ( boxes[0].tolist(), zip ( boxes[1].tolist(), boxes[2].tolist() ) ) )
+
+        # update the index with every label in every cube. exceptions are a subset of these.
+        labels, listofidxs = annindex.denseLabels ( databuffer, keys )
+        self.annoIdx.updateIndexDense(ch, labels, listofidxs, timestamp, resolution, boxes )
+
+        # overwritten labels may have shrunk
+        lost = np.unique ( np.concatenate ( [np.empty(0, dtype=np.uint32)] + [ cx for (ce, cl, cb, cx) in cuboids.itervalues() ] ) )
+        if len(lost):
+          self.annoIdx.invalidateBoundingBoxes(ch, lost.tolist(), timestamp, resolution)
 
     except:
       self.kvio.rollback()
@@ -359,8 +614,6 @@ class SpatialDB:
   def shaveDense ( self, ch, entityid, timestamp, corner, resolution, annodata ):
     """Process all the annotations in the dense volume"""
 
-    index_dict = defaultdict(set)
-
     # dim is in xyz, data is in zyxj
     dim = [ annodata.shape[2], annodata.shape[1], annodata.shape[0] ]
 
@@ -383,43 +636,29 @@ class SpatialDB:
     databuffer = np.zeros ([znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=np.uint32 )
     databuffer [ zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0] ] = annodata 
 
+    # morton keys of the cubes in z,y,x order
+    keys = zindex.cubeKeys ( [xstart, ystart, zstart], [xnumcubes, ynumcubes, znumcubes] )
+
     # start a transaction if supported
     self.kvio.startTxn()
 
     try:
 
-      for z in range(znumcubes):
-        for y in range(ynumcubes):
-          for x in range(xnumcubes):
-
-            key = XYZMorton ([x+xstart,y+ystart,z+zstart])
-            cube = self.getCube(ch, timestamp, key, resolution, update=True)
-
-            exdata = cube.shaveDense ( timestamp, databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            for exid in np.unique ( exdata ):
-              if exid != 0:
-                # get the offsets
-                exoffsets = np.nonzero ( exdata==exid )
-                # assemble into 3-tuples zyx->xyz
-                exceptions = np.array ( zip(exoffsets[2], exoffsets[1], exoffsets[0]), dtype=np.uint32 )
-                # update the exceptions
-                self.removeExceptions ( key, timestamp, resolution, exid, exceptions )
-                # add to the index
-                index_dict[exid].add(key)
-
-            self.putCube(ch, timestamp, key, resolution, cube)
+      cuboids = self._mergeDense ( ch, timestamp, resolution, databuffer, keys, lambda cube, data: cube.shaveDense ( 0, data ) )
 
-            # update the index for the cube
-            # get the unique elements that are being added to the data
-            uniqueels = np.unique ( databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ] )
-            for el in uniqueels:
-              index_dict[el].add(key) 
+      # remove the shaved voxels from the exceptions
+      cubeexceptions = {}
+      cubelabels = {}
+      for key, (exceptions, labels, boxes, lost) in cuboids.iteritems():
+        for exid, exlist in exceptions.iteritems():
+          cubeexceptions[(key, exid)] = exlist
+        cubelabels[key] = labels
+      cubekeys = self.removeExceptionsList ( ch, timestamp, resolution, cubeexceptions )
+      self.updateCubeLabels ( ch, timestamp, resolution, cubelabels, cubekeys )
 
-            # remove 0 no reason to index that
-            del(index_dict[0])
-
-      # update all indexes
-      self.annoIdx.updateIndexDense(ch, index_dict, timestamp, resolution)
+      # update the index with every label in every cube. this clears their bounding boxes.
+      labels, listofidxs = annindex.denseLabels ( databuffer, keys )
+      self.annoIdx.updateIndexDense(ch, labels, listofidxs, timestamp, resolution)
 
     except:
       self.kvio.rollback()
@@ -433,8 +672,7 @@ class SpatialDB:
     """Takes a bitmap for an entity and calls denseShave. Renumber the annotations to match the entity id"""
 
     # make shaving a per entity operation
-    vec_func = np.vectorize ( lambda x: 0 if x == 0 else entityid ) 
-    annodata = vec_func ( annodata )
+    annodata = np.where ( annodata != 0, np.uint32(entityid), np.uint32(0) )
 
     self.shaveDense ( ch, entityid, timestamp, corner, resolution, annodata )
 
@@ -483,17 +721,21 @@ class SpatialDB:
       # find the effective dimensions of the cutout (where the data is)
       effcorner, effdim, (xpixeloffset,ypixeloffset) = self._zoominCutout (ch, corner, dim, resolution)
       effresolution = ch.resolution
+      exact = False
 
     # if cutout is above resolution, get a large cube and scaledown
     elif ch.resolution < resolution and ch.propagate not in [PROPAGATED, UNDER_PROPAGATION]:  
       effcorner, effdim = self._zoomoutCutout ( ch, corner, dim, resolution )
       effresolution = ch.resolution
+      exact = False
     # this is the default path when not scaling up the resolution
     else:
       # get the size of the image and cube
       effcorner = corner
       effdim = dim
       effresolution = resolution 
+      # no scaling so the output can be assembled at exactly the requested extent
+      exact = True
     
     if direct and self.KVENGINE == REDIS:
       [xcubedim, ycubedim, zcubedim] = cubedim = self.datasetcfg.get_supercubedim(effresolution)
@@ -507,55 +749,86 @@ class SpatialDB:
     ynumcubes = (effcorner[1]+effdim[1]+ycubedim-1)/ycubedim - ystart
     xnumcubes = (effcorner[0]+effdim[0]+xcubedim-1)/xcubedim - xstart
     
-    outcube = Cube.CubeFactory([xnumcubes*xcubedim, ynumcubes*ycubedim, znumcubes*zcubedim], ch.channel_type, ch.channel_datatype, time_range=timerange)
+    if exact:
+      # copy only the part of each cube that intersects the request
+      outcube = Cube.CubeFactory(effdim, ch.channel_type, ch.channel_datatype, time_range=timerange)
+      lowvoxel = effcorner
+    else:
+      # zooming needs whole cubes, trimmed after scaling
+      outcube = Cube.CubeFactory([xnumcubes*xcubedim, ynumcubes*ycubedim, znumcubes*zcubedim], ch.channel_type, ch.channel_datatype, time_range=timerange)
+      lowvoxel = map(mul, start, cubedim)
                                         
-    # Build a list of indexes to access
-    listofidxs = []
-    for z in range ( znumcubes ):
-      for y in range ( ynumcubes ):
-        for x in range ( xnumcubes ):
-          mortonidx = XYZMorton ( [x+xstart, y+ystart, z+zstart] )
-          listofidxs.append ( mortonidx )
-
-    # sort the indexes in morton order
-    listofidxs.sort()
+    # Build a list of indexes to access sorted in morton order
+    listofidxs = np.sort ( zindex.cubeKeys ( start, [xnumcubes, ynumcubes, znumcubes] ), axis=None ).tolist()
     listoftimestamps = range(timerange[0], timerange[1])
-    
-    # xyz offset stored for later use
-    lowxyz = MortonXYZ ( listofidxs[0] )
+
+    # xyz cube coordinates of every index
+    cubexyz = dict ( zip ( listofidxs, zindex.MortonXYZ(listofidxs).tolist() ) )
     
     self.kvio.startTxn()
 
     try:
-      if neariso and self.datasetcfg.nearisoscaledown[resolution] > 1:
-        cuboids = self.getCubes(ch, listoftimestamps, listofidxs, effresolution, neariso=True, direct=direct)
-      else:
-        cuboids = self.getCubes(ch, listoftimestamps, listofidxs, effresolution, neariso=False, direct=direct)
-      
+      cubeneariso = neariso and self.datasetcfg.nearisoscaledown[resolution] > 1
+
+      # only the cubes that hold the annotations are read, the rest of the output stays zero
+      if annoids!= None and ch.channel_type in ANNOTATION_CHANNELS and not cubeneariso and not direct:
+        listofidxs = self._indexedCubes ( ch, annoids, listoftimestamps, effresolution, listofidxs )
+
+      # read the exceptions up front so that no queries are issued while cuboids are assembled
+      cubeexceptions = {}
+      if annoids!= None and ch.channel_type in ANNOTATION_CHANNELS and ch.getExceptions() == EXCEPTION_TRUE and listofidxs:
+        cubeexceptions = self.getCubeExceptions ( ch, annoids, listoftimestamps, effresolution, listofidxs )
+
+      # decoded cubes that are cached and still current in the store are not read again
+      cached = {}
+      fetchidxs = listofidxs
+      versions = None if direct else self.getCubeVersions(ch, listoftimestamps, listofidxs, effresolution, neariso=cubeneariso)
+      if versions is not None:
+        for (idx, ts), version in versions.iteritems():
+          data = self.cache.get(self._cacheKey(ch, effresolution, idx, ts, cubeneariso), version)
+          if data is not None:
+            cached[(idx, ts)] = data
+        fetchidxs = [ idx for idx in listofidxs if any ( [ (int(idx), ts) not in cached for ts in listoftimestamps ] ) ]
+
       # if aligned:
         # for idx, timestamp, datastring in cuboids:
           # return datastring
       
-      # use the batch generator interface
-      for idx, timestamp, datastring in cuboids:
-        
-        # add the query result cube to the bigger cube
-        curxyz = MortonXYZ(int(idx))
-        offset = [ curxyz[0]-lowxyz[0], curxyz[1]-lowxyz[1], curxyz[2]-lowxyz[2] ]
+      def addCuboid ( idx, timestamp, datastring, data=None ):
+        """Decompress a query result or take a cached array and add it to the bigger cube"""
+
+        if data is None:
+          # missing cubes are zeros and the output cube starts as zeros
+          if not datastring:
+            return
 
-        # deserialize cube from blosc
-        incube = Cube.CubeFactory ( cubedim, ch.channel_type, ch.channel_datatype, time_range=[timestamp, timestamp+1])
-        incube.deserialize(datastring)
-        # incube.deserialize(datastring[:])
+          # decompress straight from blosc, no intermediate cube is allocated
+          data = Cube.unpack(datastring)
+          if versions is not None:
+            self.cache.put(self._cacheKey(ch, effresolution, idx, timestamp, cubeneariso), data, cubecache.version(datastring))
+
+        # voxel corner of the cube relative to the output cube
+        curxyz = cubexyz[int(idx)]
+        offset = [ curxyz[0]*xcubedim-lowvoxel[0], curxyz[1]*ycubedim-lowvoxel[1], curxyz[2]*zcubedim-lowvoxel[2] ]
+
+        data = data.reshape(cubedim[::-1])
 
         # apply exceptions if it's an annotation project
         if annoids!= None and ch.channel_type in ANNOTATION_CHANNELS:
-          incube.data = filter_ctype_OMP ( incube.data, annoids )
-          if ch.getExceptions() == EXCEPTION_TRUE:
-            self.applyCubeExceptions ( ch, annoids, effresolution, idx, incube )
+          # the filter works in place and cached arrays are shared
+          data = filter_ctype_OMP ( data.copy() if versions is not None else data, annoids )
+          self.overlayExceptions ( data, cubeexceptions.get((idx, timestamp), []) )
         
-        # add it to the output cube
-        outcube.addData( incube, timestamp, offset )
+        # add it to the output cube. cuboids cover disjoint regions so this is safe across threads.
+        outcube.addArray( data, timestamp, offset )
+
+      # cached arrays first, then the rows streamed by the batch generator interface
+      rows = [ (idx, ts, None, data) for (idx, ts), data in cached.iteritems() ]
+      if fetchidxs:
+        with closing(self.getCubes(ch, listoftimestamps, fetchidxs, effresolution, neariso=cubeneariso, direct=direct)) as cuboids:
+          self._mapCuboids ( addCuboid, itertools.chain(rows, cuboids), len(listofidxs)*len(listoftimestamps) )
+      else:
+        self._mapCuboids ( addCuboid, rows, len(rows) )
 
     except Exception as e:
       self.kvio.rollback()
@@ -579,6 +852,10 @@ class SpatialDB:
       # need to trime based on the cube cutout at resolution
       outcube.trim ( corner[0]%(xcubedim*(2**(ch.resolution-resolution))),dim[0], corner[1]%(ycubedim*(2**(ch.resolution-resolution))),dim[1], corner[2]%zcubedim,dim[2] )
       
+    # already assembled at the requested extent
+    elif exact:
+      pass
+
     # need to trim down the array to size only if the dimensions are not the same
     elif dim[0] % xcubedim  == 0 and dim[1] % ycubedim  == 0 and dim[2] % zcubedim  == 0 and corner[0] % xcubedim  == 0 and corner[1] % ycubedim  == 0 and corner[2] % zcubedim  == 0:
       pass
@@ -587,6 +864,51 @@ class SpatialDB:
      
     return outcube
 
+  def _indexedCubes(self, ch, annoids, listoftimestamps, resolution, listofidxs):
+    """The sorted cubes of listofidxs that the annotation indexes show hold any of annoids.
+       All of listofidxs if any of the ids has no index at this resolution, e.g. one that was never indexed."""
+
+    listofids = sorted ( set ( [ int(annid) for annid in annoids ] ) )
+    union = mortonbitmap.MortonBitmap()
+    for timestamp in listoftimestamps:
+      indexes = self.annoIdx.getIndexes ( ch, listofids, timestamp, resolution )
+      # an unindexed id may be anywhere
+      if len(indexes) < len(listofids):
+        return listofidxs
+      for index in indexes.itervalues():
+        union |= index
+
+    return union.intersection ( mortonbitmap.MortonBitmap.fromKeys(listofidxs) ).toKeys().tolist()
+
+
+  def cutoutIter(self, ch, corner, dim, resolution, timerange, annoids=None, neariso=False, direct=False):
+    """Generator over a cutout one cube aligned z-slab at a time in raster order.
+       Yields the slab corner and the slab data in t,z,y,x so that only one slab is held in memory."""
+
+    # slabs follow the cubes that cutout reads. zooming reads the channel resolution, z is never scaled.
+    if ch.resolution > resolution or ( ch.resolution < resolution and ch.propagate not in [PROPAGATED, UNDER_PROPAGATION] ):
+      effresolution = ch.resolution
+    else:
+      effresolution = resolution
+
+    if direct and self.KVENGINE == REDIS:
+      zcubedim = self.datasetcfg.get_supercubedim(effresolution)[2]
+    else:
+      zcubedim = self.datasetcfg.get_cubedim(effresolution)[2]
+
+    zlow = corner[2]
+    while zlow < corner[2]+dim[2]:
+
+      # the slab ends at the next cube boundary or the end of the request
+      zhigh = min((zlow/zcubedim+1)*zcubedim, corner[2]+dim[2])
+      slabcorner = [corner[0], corner[1], zlow]
+
+      outcube = self.cutout(ch, slabcorner, [dim[0], dim[1], zhigh-zlow], resolution, timerange, annoids=annoids, neariso=neariso, direct=direct)
+      yield (slabcorner, outcube.data)
+
+      zlow = zhigh
+
+
   # alternate to getVolume that returns a annocube
   def annoCutout ( self, ch, annoids, timestamp, resolution, corner, dim, remapid=None ):
     """Fetch a volume cutout with only the specified annotation"""
@@ -594,10 +916,9 @@ class SpatialDB:
     # cutout is zoom aware
     cube = self.cutout(ch, corner, dim, resolution, annoids=annoids, timerange=[timestamp,timestamp+1] )
 
-    # KL TODO
+    # relabel in place
     if remapid:
-      vec_func = np.vectorize ( lambda x: np.uint32(remapid) if x != 0 else np.uint32(0) ) 
-      cube.data = vec_func ( cube.data )
+      cube.data[cube.data != 0] = remapid
 
     return cube
 
@@ -639,15 +960,186 @@ class SpatialDB:
       return cube.getVoxel(timestamp, xyzoffset)
 
 
+  def getVoxels(self, ch, timestamp, resolution, points):
+    """Return the identifiers at an (N,3) array of x,y,z voxels as an array of N values.
+       Points are grouped by cube so that every cube is read and decompressed once."""
+
+    points = np.array ( points, dtype=np.int64 ).reshape(-1,3)
+
+    # same propagation rules as getVoxel
+    if ch.propagate in [NOT_PROPAGATED, UNDER_PROPAGATION]:
+      if resolution > ch.resolution:
+        points[:,:2] *= 2**(resolution-ch.resolution)
+      elif resolution < ch.resolution:
+        points[:,:2] //= 2**(ch.resolution-resolution)
+      resolution = ch.resolution
+
+    # cube and offset in the cube of every point
+    cubedim = np.array ( self.datasetcfg.cubedim[resolution], dtype=np.int64 )
+    points -= np.array ( self.datasetcfg.offset[resolution], dtype=np.int64 )
+    xyzoffset = points % cubedim
+    keys = zindex.XYZMorton ( points // cubedim )
+
+    # points that fall in missing cubes stay 0
+    values = np.zeros ( len(points), dtype=Cube.CubeFactory([1,1,1], ch.channel_type, ch.channel_datatype).data.dtype )
+    if len(points) == 0:
+      return values
+
+    # group the points by cube. each cube gets a run of the sorted order.
+    order = np.argsort ( keys, kind='mergesort' )
+    sortedkeys = keys[order]
+    breaks = np.nonzero ( np.diff(sortedkeys) )[0] + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks, len(keys)]
+    groups = dict ( zip ( sortedkeys[starts].tolist(), zip(starts.tolist(), ends.tolist()) ) )
+
+    def gatherCuboid ( idx, ts, datastring ):
+      """Decompress a cube and gather the values of its points. Points of different cubes are disjoint so this is safe across threads."""
+
+      if not datastring:
+        return
+      data = Cube.unpack(datastring).reshape(cubedim[::-1].tolist())
+      (start, end) = groups[int(idx)]
+      selected = order[start:end]
+      values[selected] = data [ xyzoffset[selected,2], xyzoffset[selected,1], xyzoffset[selected,0] ]
+
+    with closing(self.getCubes(ch, [timestamp], groups.keys(), resolution)) as cuboids:
+      self._mapCuboids ( gatherCuboid, cuboids, len(groups) )
+    return values
+
+
   def applyCubeExceptions(self, ch, annoids, timestamp, resolution, idx, cube ):
     """Apply the expcetions to a specified cube and resolution"""
 
     # for the target ids
-    for annoid in annoids:
-      # apply exceptions
-      exceptions = self.getExceptions( ch, idx, timestamp, resolution, annoid ) 
-      for e in exceptions:
-        cube.data[e[2],e[1],e[0]]=annoid
+    self.overlayExceptions ( cube.data, self.getCubeExceptions(ch, annoids, [timestamp], resolution, [idx]).get((idx, timestamp), []) )
+
+
+  def getCubeExceptions(self, ch, annoids, listoftimestamps, resolution, listofidxs ):
+    """Return a dictionary of (zidx, timestamp) to a list of (annoid, exceptions) for the target ids.
+       One batched query per timestamp. The lists follow the order of annoids."""
+
+    order = dict ( [ (int(annoid), i) for i, annoid in enumerate(annoids) ] )
+    cubeexceptions = {}
+    for timestamp in listoftimestamps:
+      for idx, keys in self.readExceptions(ch, listofidxs, timestamp, resolution, annoids).iteritems():
+        annoexceptions = exceptionrecord.fromKeys(keys)
+        if annoexceptions:
+          cubeexceptions[(idx, timestamp)] = sorted ( annoexceptions, key=lambda (annoid, exceptions): order[annoid] )
+
+    return cubeexceptions
+
+
+  def overlayExceptions(self, data, annoexceptions, remapid=None):
+    """Write a list of (annoid, exceptions) into z,y,x data in one assignment. Later ids take precedence."""
+
+    if not annoexceptions:
+      return
+
+    exceptions = np.concatenate ( [ np.asarray(exlist, dtype=np.intp).reshape(-1,3) for (annoid, exlist) in annoexceptions ] )
+    if remapid:
+      annoids = remapid
+    else:
+      annoids = np.concatenate ( [ np.full(len(exlist), annoid, dtype=data.dtype) for (annoid, exlist) in annoexceptions ] )
+    data [ ..., exceptions[:,2], exceptions[:,1], exceptions[:,0] ] = annoids
+
+
+  def _mergeDense ( self, ch, timestamp, resolution, databuffer, keys, merge, neariso=False, boxes=False ):
+    """Call merge(cube, data) for every cube under a cube aligned dense buffer. keys is the z,y,x array of morton keys.
+       The cubes are read and locked in one query, merged by the worker pool and written back in one batch.
+       Returns {zidx: (exceptions, labels, boxes, lost)} with the exceptions grouped by id and the labels left in the cube.
+       With boxes, the bounding boxes of the voxels written for each label as (labels, lows, highs) arrays.
+       lost holds the labels that had voxels replaced by another label."""
+
+    cubedim = self.datasetcfg.cubedim [ resolution ]
+    [xcubedim, ycubedim, zcubedim] = cubedim
+    [znumcubes, ynumcubes, xnumcubes] = keys.shape
+
+    # the region of the buffer for each cube
+    cubedata = {}
+    for z in range(znumcubes):
+      for y in range(ynumcubes):
+        for x in range(xnumcubes):
+          cubedata[int(keys[z,y,x])] = databuffer [ z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim ]
+    listofidxs = keys.ravel().tolist()
+
+    # read and lock every cube before any are written
+    cubestrs = dict.fromkeys(listofidxs)
+    with closing(self.getCubes ( ch, [timestamp], listofidxs, resolution, neariso=neariso, update=True )) as cuboids:
+      for idx, ts, datastring in cuboids:
+        cubestrs[int(idx)] = datastring
+
+    results = {}
+    def mergeCuboid ( idx, ts, datastring ):
+      cube = Cube.CubeFactory ( cubedim, ch.channel_type, ch.channel_datatype, time_range=[ts, ts+1] )
+      cube.deserialize ( datastring )
+      # the stored values under the written voxels
+      nonzero = ( cubedata[idx] != 0 )
+      before = cube.data.reshape(cubedata[idx].shape)[nonzero]
+      exdata = merge ( cube, cubedata[idx] )
+      after = cube.data.reshape(cubedata[idx].shape)[nonzero]
+      lost = np.unique ( before [ (before != after) & (before != 0) & (after != 0) ] )
+      cubeboxes = None
+      if boxes:
+        # voxels that took the label or hold it as an exception
+        written = ( cube.data.reshape(cubedata[idx].shape) == cubedata[idx] )
+        if exdata is not None:
+          written |= ( exdata != 0 )
+        written &= ( cubedata[idx] != 0 )
+        xyz = np.column_stack ( np.nonzero(written)[::-1] ).astype(np.int64) + zindex.MortonXYZ(idx).astype(np.int64) * cubedim
+        cubeboxes = annindex.labelBoxes ( cubedata[idx][written], xyz, xyz+1 )
+      results[idx] = ( cube.serialize(), self._denseExceptions(exdata), np.unique(cube.data), cubeboxes, lost )
+
+    self._mapCuboids ( mergeCuboid, [ (idx, timestamp, cubestrs[idx]) for idx in listofidxs ], len(listofidxs) )
+
+    self.putCubes ( ch, [timestamp], listofidxs, resolution, [ results[idx][0] for idx in listofidxs ], update=True, neariso=neariso )
+    return dict ( [ (idx, results[idx][1:]) for idx in listofidxs ] )
+
+
+  def _denseExceptions ( self, exdata ):
+    """Group the nonzero voxels of a dense cube by id. Returns {exid: array of x,y,z offsets}."""
+
+    if exdata is None:
+      return {}
+
+    zs, ys, xs = np.nonzero ( exdata )
+    ids = exdata [ zs, ys, xs ]
+    order = np.argsort ( ids, kind='mergesort' )
+    ids = ids[order]
+    xyz = np.column_stack ( (xs, ys, zs) )[order].astype(np.uint32)
+
+    # split into runs of the same id
+    breaks = np.nonzero ( np.diff(ids) )[0] + 1
+    return dict ( zip ( ids[np.r_[0, breaks]].tolist(), np.split(xyz, breaks) ) ) if len(ids) else {}
+
+
+  def _mapCuboids ( self, func, cuboids, numcuboids ):
+    """Call func(zidx, timestamp, datastring) on every row of a getCubes generator. Rows may carry extra arguments for func.
+       With more than one worker the rows are decompressed by a thread pool while the backend is still producing them."""
+
+    workers = min(self.workers, numcuboids)
+    if workers <= 1:
+      for row in cuboids:
+        func(*row)
+      return
+
+    if self.pool is None:
+      self.pool = ThreadPool(self.workers)
+
+    pending = collections.deque()
+    try:
+      for row in cuboids:
+        pending.append(self.pool.apply_async(func, row))
+        # bound the number of compressed cuboids waiting in memory
+        if len(pending) > 2*workers:
+          pending.popleft().get()
+      while pending:
+        pending.popleft().get()
+    except:
+      # the pool is shared, let the queued calls finish so none outlive this read
+      for result in pending:
+        result.wait()
+      raise
 
   
 # RBTODO test zoom in and out.
@@ -657,17 +1149,26 @@ class SpatialDB:
        This is used by both exception and the voxels data argument."""
 
     # correct for zoomed resolution
-    newvoxels = []
+    voxels = np.asarray ( voxels, dtype=np.uint32 ).reshape(-1,3)
     scaling = 2**(resgap)
-    for vox in voxels:
-      for numy in range(scaling):
-        for numx in range(scaling):
-          newvoxels.append ( (vox[0]*scaling + numx, vox[1]*scaling + numy, vox[2]) )
-    return newvoxels
+    # every voxel becomes a scaling x scaling square in x,y
+    dy, dx = np.mgrid [ 0:scaling, 0:scaling ]
+    newvoxels = np.empty ( (len(voxels), scaling*scaling, 3), dtype=np.uint32 )
+    newvoxels[:,:,0] = voxels[:,0:1]*scaling + dx.ravel()
+    newvoxels[:,:,1] = voxels[:,1:2]*scaling + dy.ravel()
+    newvoxels[:,:,2] = voxels[:,2:3]
+    return newvoxels.reshape(-1,3)
 
 
   def getLocations(self, ch, entityid, timestamp, res ):
-    """Return the list of locations associated with an identifier"""
+    """Return the locations associated with an identifier as an (N,3) array of x,y,z"""
+
+    return np.concatenate ( [ np.empty((0,3), dtype=np.uint32) ] + list ( self.getLocationsIter(ch, entityid, timestamp, res) ) )
+
+
+  def getLocationsIter(self, ch, entityid, timestamp, res ):
+    """Yield the locations associated with an identifier one cube at a time as (N,3) arrays of x,y,z.
+       The cubes are streamed from one getCubes call. Consume it before issuing other queries."""
 
     # get the size of the image and cube
     resolution = int(res)
@@ -678,48 +1179,45 @@ class SpatialDB:
     else:
       effectiveres = resolution
 
+    cubedim = self.datasetcfg.get_cubedim(effectiveres)
 
-    voxlist = []
-    
-    zidxs = self.annoIdx.getIndex(ch,entityid,timestamp,resolution)
-
-    for zidx in zidxs:
+    zidxs = self.annoIdx.getIndex(ch, entityid, timestamp, effectiveres)
+    if len(zidxs) == 0:
+      return
+    zidxs = np.asarray(zidxs, dtype=np.uint64).tolist()
 
-      cb = self.getCube(ch, timestamp, zidx, effectiveres) 
+    # prefetch the exception voxels
+    exceptions = {}
+    if ch.getExceptions() ==  EXCEPTION_TRUE:
+      for zidx, keys in self.readExceptions(ch, zidxs, timestamp, effectiveres, [entityid]).iteritems():
+        for exid, voxels in exceptionrecord.fromKeys(keys):
+          exceptions[zidx] = voxels
 
-      # mask out the entries that do not match the annotation id
-      # KL TODO
-      vec_func = np.vectorize ( lambda x: entityid if x == entityid else 0 )
-      annodata = vec_func ( cb.data )
-    
-      # where are the entries
-      offsets = np.nonzero ( annodata[0,:,:,:] ) 
-      voxels = np.array(zip(offsets[2], offsets[1], offsets[0]), dtype=np.uint32)
+    with closing(self.getCubes(ch, [timestamp], zidxs, effectiveres)) as cuboids:
+      for zidx, ts, datastring in cuboids:
 
-      # Get cube offset information
-      [x,y,z] = MortonXYZ(zidx)
-      xoffset = x * self.datasetcfg.cubedim[resolution][0] + self.datasetcfg.offset[resolution][0] 
-      yoffset = y * self.datasetcfg.cubedim[resolution][1] + self.datasetcfg.offset[resolution][1]
-      zoffset = z * self.datasetcfg.cubedim[resolution][2] + self.datasetcfg.offset[resolution][2]
+        # where are the entries. a missing cube is empty but may still hold exceptions.
+        if datastring:
+          zs, ys, xs = np.nonzero ( Cube.unpack(datastring).reshape(cubedim[::-1]) == entityid )
+          voxels = np.column_stack ( (xs, ys, zs) ).astype(np.uint32)
+        else:
+          voxels = np.empty ( (0,3), dtype=np.uint32 )
 
-      # Now add the exception voxels
-      if ch.getExceptions() ==  EXCEPTION_TRUE:
-        exceptions = self.getExceptions( ch, timestamp, zidx, resolution, entityid ) 
-        if exceptions != []:
-          voxels = np.append ( voxels.flatten(), exceptions.flatten())
-          voxels = voxels.reshape(len(voxels)/3,3)
+        # Now add the exception voxels
+        if int(zidx) in exceptions:
+          voxels = np.concatenate ( (voxels, exceptions[int(zidx)].astype(np.uint32)) )
 
-      # Change the voxels back to image address space
-      [ voxlist.append([a+xoffset, b+yoffset, c+zoffset]) for (a,b,c) in voxels ] 
+        # Change the voxels back to image address space
+        voxels += ( zindex.MortonXYZ(zidx) * cubedim + self.datasetcfg.offset[effectiveres] ).astype(np.uint32)
 
-    # zoom out the voxels if necessary 
-    if effectiveres > resolution:
-      voxlist = self.zoomVoxels ( voxlist, effectiveres-resolution )
+        # zoom out the voxels if necessary 
+        if effectiveres > resolution:
+          voxels = self.zoomVoxels ( voxels, effectiveres-resolution )
 
-    return voxlist
+        yield voxels
 
 
-  def getBoundingBox(self, ch, annids, res):
+  def getBoundingBox(self, ch, annids, res, timestamp=0):
     """Return a corner and dimension of the bounding box for an annotation using the index"""
   
     # get the size of the image and cube
@@ -739,6 +1237,15 @@ class SpatialDB:
       effectiveres = resolution
       scaling=1
 
+    # use the stored bounding boxes when every annotation has one
+    boxes = self.annoIdx.getBoundingBoxes(ch, [int(annid) for annid in annids], timestamp, effectiveres)
+    if boxes and len(boxes) == len(set([int(annid) for annid in annids])):
+      [xmin, ymin, zmin] = np.amin ( [ low for (low, high) in boxes.values() ], axis=0 )
+      [xmax, ymax, zmax] = np.amax ( [ high for (low, high) in boxes.values() ], axis=0 )
+      corner = [ int(xmin*scaling), int(ymin*scaling), int(zmin) ]
+      dim = [ int(xmax*scaling)-corner[0], int(ymax*scaling)-corner[1], int(zmax)-corner[2] ]
+      return (corner, dim)
+
     # all boxes in the indexes
     zidxs=[]
     for annid in annids:
@@ -812,6 +1319,53 @@ class SpatialDB:
     return (corner, dim)
 
 
+  def rebuildBoundingBox ( self, ch, annid, resolution, timestamp=0 ):
+    """Recompute the stored bounding box of an annotation from its cubes and exceptions"""
+
+    cubedim = self.datasetcfg.get_cubedim(resolution)
+
+    self.kvio.startTxn()
+
+    try:
+
+      index = self.annoIdx.getBitmap(ch, annid, timestamp, resolution, True)
+      if index is None:
+        self.kvio.commit()
+        return
+      listofidxs = index.toKeys().tolist()
+
+      # low and high corners of the labeled voxels in each cube
+      lows = []
+      highs = []
+      with closing(self.getCubes(ch, [timestamp], listofidxs, resolution)) as cuboids:
+        for idx, ts, datastring in cuboids:
+          if not datastring:
+            continue
+          data = Cube.unpack(datastring)
+          zs, ys, xs = np.nonzero ( data.reshape(cubedim[::-1]) == annid )
+          if len(zs):
+            offset = zindex.MortonXYZ(idx).astype(np.int64) * cubedim
+            lows.append ( [xs.min(), ys.min(), zs.min()] + offset )
+            highs.append ( [xs.max(), ys.max(), zs.max()] + offset + 1 )
+
+      # voxels that hold the label as an exception
+      if ch.getExceptions() == EXCEPTION_TRUE:
+        for idx, keys in self.readExceptions(ch, listofidxs, timestamp, resolution, [annid]).iteritems():
+          for exid, exceptions in exceptionrecord.fromKeys(keys):
+            offset = zindex.MortonXYZ(idx).astype(np.int64) * cubedim
+            lows.append ( exceptions.min(axis=0) + offset )
+            highs.append ( exceptions.max(axis=0) + offset + 1 )
+
+      bbox = ( np.amin(lows, axis=0).tolist(), np.amax(highs, axis=0).tolist() ) if lows else None
+      self.annoIdx.putIndex(ch, annid, timestamp, resolution, index, True, bbox)
+
+    except:
+      self.kvio.rollback()
+      raise
+
+    self.kvio.commit()
+
+
   def getBoundingCube ( self, ch, annids, timestamp, res ):
     """Return a corner and dimension of the bounding cuboid for an annotation using the index"""
   
@@ -868,6 +1422,12 @@ class SpatialDB:
     zidxs = set()
     for did in dataids:
       zidxs |= set ( self.annoIdx.getIndex(ch, did, timestamp, effectiveres))
+    zidxs = sorted ( [ int(zidx) for zidx in zidxs ] )
+
+    # Get exceptions if this DB supports it
+    cubeexceptions = {}
+    if ch.getExceptions() == EXCEPTION_TRUE and zidxs:
+      cubeexceptions = self.getCubeExceptions(ch, dataids, [timestamp], effectiveres, zidxs)
 
     for zidx in zidxs:
 
@@ -877,9 +1437,8 @@ class SpatialDB:
         cb.data = filter_ctype_OMP ( cb.data, dataids )
       else: 
         cb.data = filter_ctype_OMP ( cb.data, dataids )
-        # KL TODO
-        vec_func = np.vectorize ( lambda x: np.uint32(remapid) if x != 0 else np.uint32(0) ) 
-        cb.data = vec_func ( cb.data )
+        # relabel in place
+        cb.data[cb.data != 0] = remapid
 
       # zoom the data if not at the right resolution and translate the zindex to the upper resolution
       (xoff,yoff,zoff) = MortonXYZ ( zidx )
@@ -891,20 +1450,11 @@ class SpatialDB:
         offset = (offset[0]*(2**(effectiveres-resolution)),offset[1]*(2**(effectiveres-resolution)),offset[2])
 
       # add any exceptions
-      # Get exceptions if this DB supports it
-      if ch.getExceptions() == EXCEPTION_TRUE:
-        for exid in dataids:
-          exceptions = self.getExceptions(ch, timestamp, zidx, effectiveres, exid) 
-          if exceptions != []:
-            if resolution < effectiveres:
-                exceptions = self.zoomVoxels ( exceptions, effectiveres-resolution )
-            # write as a loop first, then figure out how to optimize 
-            # exceptions are stored relative to cube offset
-            for e in exceptions:
-              if not remapid:
-                cb.data[e[2],e[1],e[0]]=exid
-              else:
-                cb.data[e[2],e[1],e[0]]=remapid
+      # exceptions are stored relative to cube offset
+      annoexceptions = cubeexceptions.get((int(zidx), timestamp), [])
+      if resolution < effectiveres:
+        annoexceptions = [ (exid, self.zoomVoxels(exceptions, effectiveres-resolution)) for (exid, exceptions) in annoexceptions ]
+      self.overlayExceptions ( cb.data, annoexceptions, remapid )
 
       yield (offset,cb.data)
 
@@ -925,17 +1475,22 @@ class SpatialDB:
         zidxs = self.annoIdx.getIndex(ch, annoid, 0, res,True)
         
         # delete annotation data
+        cubelabels = {}
         for key in zidxs:
           cube = self.getCube(ch, 0, key, res, update=True)
-          # KL TODO
-          vec_func = np.vectorize ( lambda x: np.uint32(0) if x == annoid else x )
-          cube.data = vec_func ( cube.data )
-          # remove the exceptions
-          if ch.getExceptions == EXCEPTION_TRUE:
-            self.kvio.deleteExceptions(ch, key, 0, res, annoid)
+          # zero the annotation in place
+          cube.data[cube.data == annoid] = 0
           self.putCube(ch, 0, key, res, cube)
+          cubelabels[key] = np.unique ( cube.data )
+
+        # remove the exceptions
+        cubekeys = {}
+        if ch.getExceptions() == EXCEPTION_TRUE:
+          cubekeys = self.deleteExceptionIds(ch, zidxs, 0, res, [annoid])
+
+        self.updateCubeLabels(ch, 0, res, cubelabels, cubekeys)
         
-      # delete index
+      # delete index. its bounding box goes with it.
       self.annoIdx.deleteIndex(ch, annoid,resolutions)
 
     except:
@@ -1006,7 +1561,7 @@ class SpatialDB:
    # self.kvio.commit()
 
 
-  def writeCuboid(self, ch, corner, resolution, cuboiddata, timerange=[0,1], neariso=False, direct=False):
+  def writeCuboid(self, ch, corner, resolution, cuboiddata, timerange=[0,1], neariso=False, direct=False, blind=False):
     """
     Write a 4D volume to the key-value store.
 
@@ -1020,6 +1575,8 @@ class SpatialDB:
     :type cuboiddata: Multi-dimensional numpy array
     :type timerange: one-dimensional list of int
     :param timerange: Range of time. Defaults to None
+    :param blind: Replace cubes fully covered by cuboiddata without reading them. Zero voxels overwrite existing data. Defaults to False
+    :type blind: bool
 
     :returns: None
     """
@@ -1043,15 +1600,29 @@ class SpatialDB:
     databuffer = np.zeros([timerange[1]-timerange[0]]+[znumcubes*zcubedim, ynumcubes*ycubedim, xnumcubes*xcubedim], dtype=cuboiddata.dtype )
     databuffer[:, zoffset:zoffset+dim[2], yoffset:yoffset+dim[1], xoffset:xoffset+dim[0]] = cuboiddata 
     
+    # morton keys of the cubes in z,y,x order
+    keys = zindex.cubeKeys ( start, [xnumcubes, ynumcubes, znumcubes] ).tolist()
+
+    # cubes that are fully covered by the data and can be written blind
+    listofidxs = []
+    listofoffsets = []
+
     self.kvio.startTxn()
     try:
       for z in range(znumcubes):
         for y in range(ynumcubes):
           for x in range(xnumcubes):
+
+            zidx = keys[z][y][x]
+
+            # skip the read-modify-write when the cube is going to be overwritten entirely
+            if blind and x*xcubedim >= xoffset and (x+1)*xcubedim <= xoffset+dim[0] and y*ycubedim >= yoffset and (y+1)*ycubedim <= yoffset+dim[1] and z*zcubedim >= zoffset and (z+1)*zcubedim <= zoffset+dim[2]:
+              listofidxs.append(zidx)
+              listofoffsets.append((x,y,z))
+              continue
+
             for timestamp in range(timerange[0], timerange[1], 1):
 
-              zidx = XYZMorton([x+xstart,y+ystart,z+zstart])
-              # KL TODO make a blind version of the write here which does not get/put
               cube = self.getCube(ch, timestamp, zidx, resolution, update=True, neariso=neariso, direct=direct)
 
               # KLTODO in test_probability.py overwrite does not work for float32.
@@ -1060,9 +1631,20 @@ class SpatialDB:
 
               # update in the database
               self.putCube(ch, timestamp, zidx, resolution, cube, neariso=neariso, direct=direct)
-        # RB hack to commit when the file is too big for mysql log
+        # write large slabs as we go. the transaction stays open.
         if xnumcubes * ynumcubes >= 100:
-          self.kvio.commit()
+          self.kvio.flushCubes()
+
+      # write all the blind cubes in one batch, ordered by timestamp and then zindex
+      if listofidxs:
+        incube = Cube.CubeFactory(cubedim, ch.channel_type, ch.channel_datatype)
+        listofcubes = []
+        for timestamp in range(timerange[0], timerange[1], 1):
+          t = timestamp-timerange[0]
+          for (x,y,z) in listofoffsets:
+            incube.data = databuffer[t:t+1, z*zcubedim:(z+1)*zcubedim, y*ycubedim:(y+1)*ycubedim, x*xcubedim:(x+1)*xcubedim]
+            listofcubes.append(incube.serialize())
+        self.putCubes(ch, range(timerange[0], timerange[1]), listofidxs, resolution, listofcubes, update=True, neariso=neariso, direct=direct)
 
     except:
       self.kvio.rollback()
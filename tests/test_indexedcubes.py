@@ -0,0 +1,57 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from spdb.spatialdb import SpatialDB
+from spdb.mortonbitmap import MortonBitmap
+
+
+class FakeAnnoIdx:
+  """Annotation index that holds a bitmap for some ids"""
+
+  def __init__ ( self, indexes ):
+    self.indexes = indexes
+
+  def getIndexes ( self, ch, listofids, timestamp, resolution, update=False ):
+    return dict ( [ (annid, self.indexes[annid]) for annid in listofids if annid in self.indexes ] )
+
+
+class FakeDB:
+  """Just enough of a SpatialDB for _indexedCubes"""
+
+  def __init__ ( self, indexes ):
+    self.annoIdx = FakeAnnoIdx ( indexes )
+
+  _indexedCubes = SpatialDB._indexedCubes.im_func
+
+
+LISTOFIDXS = range(16)
+
+
+def test_indexed_ids_select_their_cubes ():
+
+  db = FakeDB ( { 1: MortonBitmap.fromKeys([2,3]), 2: MortonBitmap.fromKeys([3,9,40]) } )
+  assert db._indexedCubes ( None, [1,2], [0], 0, LISTOFIDXS ) == [2,3,9]
+
+
+def test_unindexed_id_reads_every_cube ():
+
+  # id 7 has no index, its voxels may be in any cube
+  db = FakeDB ( { 1: MortonBitmap.fromKeys([2,3]) } )
+  assert db._indexedCubes ( None, [1,7], [0], 0, LISTOFIDXS ) == LISTOFIDXS
+
+
+def test_no_indexed_id_reads_every_cube ():
+
+  db = FakeDB ( {} )
+  assert db._indexedCubes ( None, [7], [0], 0, LISTOFIDXS ) == LISTOFIDXS
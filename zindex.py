@@ -0,0 +1,88 @@
+# Copyright 2014 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+"""
+.. module:: zindex
+    :synopsis: Vectorized Morton order encoding and decoding for arrays of cube coordinates.
+    Keys match XYZMorton/MortonXYZ in ndlib: bit i of x, y, z goes to bit 3i, 3i+1, 3i+2 of the key.
+"""
+
+# 21 bits of each coordinate fit in a 64 bit key
+LOWBITS = np.uint64(0x1fffff)
+
+# shifts and masks that spread the lower 21 bits of a coordinate into every third bit
+SPREAD = [ (np.uint64(32), np.uint64(0x1f00000000ffff)),
+           (np.uint64(16), np.uint64(0x1f0000ff0000ff)),
+           (np.uint64(8),  np.uint64(0x100f00f00f00f00f)),
+           (np.uint64(4),  np.uint64(0x10c30c30c30c30c3)),
+           (np.uint64(2),  np.uint64(0x1249249249249249)) ]
+
+
+def _spread ( coords ):
+  """Insert two zero bits after each of the lower 21 bits"""
+
+  coords = coords & LOWBITS
+  for shift, mask in SPREAD:
+    coords = ( coords | (coords << shift) ) & mask
+  return coords
+
+
+def _compact ( keys ):
+  """Gather every third bit into the lower 21 bits. Inverse of _spread."""
+
+  keys = keys & SPREAD[4][1]
+  keys = ( keys ^ (keys >> SPREAD[4][0]) ) & SPREAD[3][1]
+  keys = ( keys ^ (keys >> SPREAD[3][0]) ) & SPREAD[2][1]
+  keys = ( keys ^ (keys >> SPREAD[2][0]) ) & SPREAD[1][1]
+  keys = ( keys ^ (keys >> SPREAD[1][0]) ) & SPREAD[0][1]
+  keys = ( keys ^ (keys >> SPREAD[0][0]) ) & LOWBITS
+  return keys
+
+
+def XYZMorton ( xyz ):
+  """Morton keys for an array of [x,y,z] coordinates. The last axis holds x,y,z."""
+
+  xyz = np.asarray ( xyz, dtype=np.uint64 )
+  return _spread(xyz[...,0]) | ( _spread(xyz[...,1]) << np.uint64(1) ) | ( _spread(xyz[...,2]) << np.uint64(2) )
+
+
+def MortonXYZ ( keys ):
+  """[x,y,z] coordinates for an array of Morton keys. Adds a last axis that holds x,y,z."""
+
+  keys = np.asarray ( keys, dtype=np.uint64 )
+  return np.stack ( [ _compact(keys), _compact(keys >> np.uint64(1)), _compact(keys >> np.uint64(2)) ], axis=-1 )
+
+
+def cubeKeys ( start, numcubes ):
+  """Morton keys for a box of cubes as a z,y,x array. Start and numcubes are in x,y,z."""
+
+  zs, ys, xs = np.mgrid [ start[2]:start[2]+numcubes[2], start[1]:start[1]+numcubes[1], start[0]:start[0]+numcubes[0] ]
+  return XYZMorton ( np.stack ( [xs, ys, zs], axis=-1 ) )
+
+
+def mortonRanges ( keys ):
+  """Coalesce Morton keys into the fewest contiguous [low, high] ranges. Returns a list of inclusive (low, high) tuples in order."""
+
+  keys = np.unique ( np.asarray ( keys, dtype=np.uint64 ) )
+  if len(keys) == 0:
+    return []
+
+  # a new range starts wherever consecutive keys differ by more than one
+  breaks = np.nonzero ( np.diff(keys) != 1 )[0] + 1
+  lows = keys [ np.r_[0, breaks] ]
+  highs = keys [ np.r_[breaks-1, len(keys)-1] ]
+
+  return zip ( lows.tolist(), highs.tolist() )